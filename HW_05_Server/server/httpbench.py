@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+import http.client as httplib
+import json
+import logging
+import platform
+import sys
+import time
+
+from multiprocessing import Pool, cpu_count
+from optparse import OptionParser
+from threading import Lock, Thread
+
+# -------------------------- Constants --------------------------- #
+
+# Workloads over bundled httptest document root:
+# name -> (path, expected status, keep connection alive)
+WORKLOADS = {
+    "small_file": ("/httptest/dir2/page.html", 200, False),
+    "large_file": ("/httptest/wikipedia_russia.html", 200, False),
+    "not_found": ("/httptest/smdklcdsmvdfjnvdfjvdfvdfvdsfssdmfdsdfsd.html",
+                  404, False),
+    "directory_index": ("/httptest/dir2/", 200, False),
+    "keep_alive": ("/httptest/dir2/page.html", 200, True),
+}
+
+DEFAULT_WORKLOADS = "small_file,large_file,not_found,directory_index,keep_alive"
+DEFAULT_CONCURRENCY = "1,10,50"
+
+PERCENTILES = (50, 90, 99)
+TIMEOUT = 10
+
+
+# ------------------------ Load generator ------------------------ #
+
+def percentile(sorted_values, percent):
+    """
+    :param sorted_values: sorted list of numbers
+    :param percent: percentile from 0 to 100
+    :return: value of percentile by nearest-rank method
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(percent / 100 * len(sorted_values))), 1)
+    return sorted_values[rank - 1]
+
+
+def split(total, parts):
+    """
+    :return: list of parts sizes which sum is equal to total
+    """
+    return [total // parts + (1 if i < total % parts else 0)
+            for i in range(parts)]
+
+
+def run_connection(host, port, path, expected_status, keep_alive,
+                   requests_count, stats, lock):
+    """
+    :param host: server host
+    :param port: server port
+    :param path: request target
+    :param expected_status: status of correct response
+    :param keep_alive: send all requests through one persistent connection,
+    http.client reconnects by itself when server closes it, such reconnects
+    are counted
+    :param requests_count: number of requests to send
+    :param stats: dictionary with latencies, errors, received bytes and
+    reconnects
+    :param lock: threading.Lock for changing stats
+    """
+    latencies, errors, received, reconnects = [], 0, 0, 0
+    conn = httplib.HTTPConnection(host, port, timeout=TIMEOUT)
+
+    for i in range(requests_count):
+        start = time.perf_counter()
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            data = response.read()
+        except (OSError, httplib.HTTPException):
+            conn.close()
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+        received += len(data)
+
+        if response.status != expected_status:
+            errors += 1
+        if not keep_alive:
+            conn.close()
+        elif response.will_close and i < requests_count - 1:
+            reconnects += 1
+
+    conn.close()
+    with lock:
+        stats["latencies"].extend(latencies)
+        stats["errors"] += errors
+        stats["bytes"] += received
+        stats["reconnects"] += reconnects
+
+
+def run_client(args):
+    """
+    :param args: tuple with host, port, workload name, number of
+    connections and number of requests of the client process
+    :return: dictionary with latencies, errors, received bytes and reconnects
+
+    Function runs one thread per concurrent connection in the client process
+    """
+    host, port, workload, connections, requests_count = args
+    path, expected_status, keep_alive = WORKLOADS[workload]
+    stats = {"latencies": [], "errors": 0, "bytes": 0, "reconnects": 0}
+    lock = Lock()
+
+    threads = []
+    for count in split(requests_count, connections):
+        thread = Thread(target=run_connection,
+                        args=(host, port, path, expected_status, keep_alive,
+                              count, stats, lock))
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+    return stats
+
+
+def run_workload(pool, options, workload, concurrency):
+    """
+    :param pool: multiprocessing.Pool of client processes
+    :param options: options from OptionsParser
+    :param workload: name of workload from WORKLOADS
+    :param concurrency: number of simultaneous connections
+    :return: dictionary with results of the workload
+    """
+    clients = min(options.clients, concurrency)
+    requests_count = max(options.requests, concurrency)
+    tasks = [(options.host, options.port, workload, connections, count)
+             for connections, count in zip(split(concurrency, clients),
+                                           split(requests_count, clients))]
+
+    # Warm up server caches and connections, results are dropped
+    if options.warmup:
+        pool.map(run_client, [(options.host, options.port, workload,
+                               1, options.warmup)])
+
+    start = time.perf_counter()
+    results = pool.map(run_client, tasks)
+    duration = time.perf_counter() - start
+
+    latencies = sorted(latency for result in results
+                       for latency in result["latencies"])
+    errors = sum(result["errors"] for result in results)
+    received = sum(result["bytes"] for result in results)
+    reconnects = sum(result["reconnects"] for result in results)
+
+    latency_ms = dict(("p{}".format(percent),
+                       round(percentile(latencies, percent) * 1000, 3))
+                      for percent in PERCENTILES)
+    latency_ms["mean"] = round(sum(latencies) / len(latencies) * 1000, 3) \
+        if latencies else 0.0
+    latency_ms["max"] = round(latencies[-1] * 1000, 3) if latencies else 0.0
+
+    return {
+        "workload": workload,
+        "path": WORKLOADS[workload][0],
+        "concurrency": concurrency,
+        "requests": requests_count,
+        "errors": errors,
+        "reconnects": reconnects,
+        "duration": round(duration, 3),
+        "requests_per_sec": round(len(latencies) / duration, 2),
+        "bytes_per_sec": round(received / duration, 2),
+        "latency_ms": latency_ms,
+    }
+
+
+# ---------------------------- Report ---------------------------- #
+
+def print_report(results, baseline=None):
+    """
+    :param results: list with results of workloads
+    :param baseline: results of previous run to compare with
+    """
+    previous = {}
+    for result in (baseline or {}).get("results", []):
+        previous[(result["workload"], result["concurrency"])] = result
+
+    line = "{:<16} {:>5} {:>10} {:>12} {:>9} {:>9} {:>9} {:>7} {:>8} {:>9}"
+    print(line.format("workload", "conc", "req/sec", "KB/sec",
+                      "p50 ms", "p90 ms", "p99 ms", "errors", "reconn",
+                      "vs base"),
+          file=sys.stderr)
+
+    for result in results:
+        base = previous.get((result["workload"], result["concurrency"]))
+        change = "{:+.1%}".format(
+            result["requests_per_sec"] / base["requests_per_sec"] - 1) \
+            if base and base["requests_per_sec"] else "-"
+        print(line.format(result["workload"], result["concurrency"],
+                          result["requests_per_sec"],
+                          round(result["bytes_per_sec"] / 1024, 1),
+                          result["latency_ms"]["p50"],
+                          result["latency_ms"]["p90"],
+                          result["latency_ms"]["p99"],
+                          result["errors"], result["reconnects"],
+                          change),
+              file=sys.stderr)
+
+
+def main(options):
+    """
+    :param options: options from OptionsParser
+    :return: dictionary with description of the run and results of workloads
+    """
+    workloads = options.workloads.split(",")
+    for workload in workloads:
+        if workload not in WORKLOADS:
+            raise ValueError("Unknown workload {}".format(workload))
+    concurrency_levels = [int(level) for level in
+                          options.concurrency.split(",")]
+
+    results = []
+    with Pool(options.clients) as pool:
+        for workload in workloads:
+            for concurrency in concurrency_levels:
+                logging.info("Running {} with concurrency {}".format(
+                    workload, concurrency))
+                results.append(run_workload(pool, options,
+                                            workload, concurrency))
+
+    return {
+        "label": options.label,
+        "host": options.host,
+        "port": options.port,
+        "clients": options.clients,
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "cpu_count": cpu_count(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+
+
+# ---------------------------- Main ----------------------------- #
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-H", "--host", action="store", default="localhost")
+    op.add_option("-p", "--port", action="store", type=int, default=8000)
+    op.add_option("-n", "--requests", action="store", type=int, default=2000)
+    op.add_option("-c", "--concurrency", action="store",
+                  default=DEFAULT_CONCURRENCY)
+    op.add_option("--workloads", action="store", default=DEFAULT_WORKLOADS)
+    op.add_option("--clients", action="store", type=int,
+                  default=max(cpu_count() // 2, 1))
+    op.add_option("--warmup", action="store", type=int, default=50)
+    op.add_option("--label", action="store", default="")
+    op.add_option("-o", "--output", action="store", default=None)
+    op.add_option("--baseline", action="store", default=None)
+    (opts, args) = op.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+
+    report = main(opts)
+
+    baseline_report = None
+    if opts.baseline:
+        with open(opts.baseline) as baseline_file:
+            baseline_report = json.load(baseline_file)
+    print_report(report["results"], baseline_report)
+
+    if opts.output:
+        with open(opts.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -1,12 +1,26 @@
 import datetime
+import html
+import json
 import logging
 import os
-import re
+import signal
 import socket
+import stat
+import struct
+import time
 
 from optparse import OptionParser
 from socket import SO_REUSEADDR, SOL_SOCKET
-from threading import Thread
+from multiprocessing.sharedctypes import RawArray
+from threading import Event, Lock, Thread
+from urllib.parse import parse_qs, quote, unquote
+
+# SO_REUSEPORT is not available on every platform, processes fall back
+# to one listening socket shared by all of them
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", None)
+
+# TCP_INFO of listening socket tells length of accept queue on Linux
+TCP_INFO = getattr(socket, "TCP_INFO", None)
 
 # -------------------------- Constants --------------------------- #
 
@@ -15,6 +29,8 @@ BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
 METHOD_NOT_ALLOWED = 405
+REQUEST_TIMEOUT = 408
+SERVICE_UNAVAILABLE = 503
 
 CODE_SPECIFICATION = {
     BAD_REQUEST: "Bad Request",
@@ -22,15 +38,22 @@ CODE_SPECIFICATION = {
     OK: "OK",
     NOT_FOUND: "Not Found",
     METHOD_NOT_ALLOWED: "Method Not Allowed",
+    REQUEST_TIMEOUT: "Request Timeout",
+    SERVICE_UNAVAILABLE: "Service Unavailable",
 }
 
 HTTP_VERSION = "HTTP/1.1"
 CHUNK_SIZE = 4096
 
-PATTERN_END_OF_REQUEST = b'(.|\s)*(\r\n\r\n|\n\n)'
+END_OF_HEADERS = (b'\r\n\r\n', b'\n\n')
 END_OF_REQUEST = '\r\n\r\n'
+MAX_REQUEST_SIZE = 65536
+
+HEADER_TIMEOUT = 10
+WRITE_TIMEOUT = 30
 
 DOCUMENT_ROOT = "/httptest"
+INDEX_FILE = "index.html"
 
 MIME_TYPES = {
     ".html": "text/html",
@@ -44,14 +67,389 @@ MIME_TYPES = {
     ".txt": "text/plain",
 }
 
-ESCAPE_PATTERN = r'%\w{2}'
+LISTEN_BACKLOG = 1024
+ACCEPT_TIMEOUT = 1
+MASTER_POLL_INTERVAL = 0.5
+
+PATH_CACHE_TTL = 5
+PATH_CACHE_SIZE = 10000
+
+LISTING_PAGE_SIZE = 1000
+LISTING_CACHE_SIZE = 1000
+JSON_CONTENT_TYPE = "application/json"
+
+STATS_PATH = "/__stats"
+STATS_CONTENT_TYPE = "text/plain; version=0.0.4"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+# ---------------------- Connection guard ------------------------ #
+
+class ConnectionGuard:
+    """
+    Deadlines of connections and limit of simultaneous connections
+    from one ip address shared by threads of one process
+    """
+
+    def __init__(self, header_timeout=HEADER_TIMEOUT,
+                 write_timeout=WRITE_TIMEOUT, max_per_ip=0):
+        self.header_timeout = header_timeout
+        self.write_timeout = write_timeout
+        self.max_per_ip = max_per_ip
+        self.connections = {}
+        self.lock = Lock()
+
+    def acquire(self, ip):
+        """
+        :param ip: ip address of client
+        :return: True if one more connection from ip is allowed
+        """
+        if not self.max_per_ip:
+            return True
+        with self.lock:
+            count = self.connections.get(ip, 0)
+            if count >= self.max_per_ip:
+                return False
+            self.connections[ip] = count + 1
+            return True
+
+    def release(self, ip):
+        """
+        :param ip: ip address of client which connection is closed
+        """
+        if not self.max_per_ip:
+            return
+        with self.lock:
+            count = self.connections.pop(ip, 0) - 1
+            if count > 0:
+                self.connections[ip] = count
+
+
+# ------------------------- Path cache --------------------------- #
+
+class PathCache:
+    """
+    Cache of resolved request targets shared by threads of one process.
+    Entries live ttl seconds, so created or removed files are noticed
+    not later than in ttl seconds. When the cache is full the oldest
+    entry is evicted.
+    """
+
+    def __init__(self, ttl=PATH_CACHE_TTL, max_size=PATH_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = {}
+        self.lock = Lock()
+
+    def get(self, key):
+        """
+        :param key: request target without query string
+        :return: cached resolution or None if there is no valid one
+        """
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+
+    def set(self, key, value):
+        """
+        :param key: request target without query string
+        :param value: resolution of the target
+        """
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            if key not in self.entries and len(self.entries) >= self.max_size:
+                self.entries.pop(next(iter(self.entries)), None)
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+
+
+# ----------------------- Listing cache -------------------------- #
+
+class ListingCache:
+    """
+    Directory listings shared by threads of one process. Sorted names of
+    a directory are cached while the directory mtime is not changed, pages
+    of listing are rendered from them, so only entries of the requested
+    page are stat'ed. Rendered pages live also not longer than ttl seconds
+    because changed size of a file does not change mtime of its directory.
+    """
+
+    def __init__(self, page_size=LISTING_PAGE_SIZE, ttl=PATH_CACHE_TTL,
+                 max_size=LISTING_CACHE_SIZE):
+        self.page_size = page_size
+        self.ttl = ttl
+        self.max_size = max_size
+        self.names = {}
+        self.pages = {}
+        self.lock = Lock()
+
+    def store(self, cache, key, value):
+        with self.lock:
+            if key not in cache and len(cache) >= self.max_size:
+                cache.pop(next(iter(cache)), None)
+            cache[key] = value
+
+    def get_names(self, directory, mtime):
+        """
+        :param directory: real path of directory
+        :param mtime: current mtime of directory in nanoseconds
+        :return: sorted list of tuples (name, is directory)
+        """
+        entry = self.names.get(directory)
+        if entry and entry[0] == mtime:
+            return entry[1]
+
+        with os.scandir(directory) as entries:
+            names = sorted((entry.name, entry.is_dir()) for entry in entries)
+        self.store(self.names, directory, (mtime, names))
+        return names
+
+    def get_page(self, directory, base, page, fmt):
+        """
+        :param directory: real path of directory
+        :param base: decoded request path of directory ending with slash
+        :param page: number of page starting from 1
+        :param fmt: html or json
+        :return: tuple with content and content type of the page or
+        None if there is no such page
+        """
+        mtime = os.stat(directory).st_mtime_ns
+        key = (directory, base, page, fmt)
+        entry = self.pages.get(key)
+        if entry and entry[0] == mtime and entry[1] > time.monotonic():
+            return entry[2]
+
+        names = self.get_names(directory, mtime)
+        pages = max((len(names) + self.page_size - 1) // self.page_size, 1)
+        if page > pages:
+            return None
+
+        start = (page - 1) * self.page_size
+        rows = []
+        for name, is_dir in names[start:start + self.page_size]:
+            try:
+                info = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            rows.append((name, is_dir, info.st_size, info.st_mtime))
+
+        if fmt == "json":
+            rendered = (self.render_json(base, page, pages, rows),
+                        JSON_CONTENT_TYPE)
+        else:
+            rendered = (self.render_html(base, page, pages, rows),
+                        MIME_TYPES[".html"])
+        self.store(self.pages, key,
+                   (mtime, time.monotonic() + self.ttl, rendered))
+        return rendered
+
+    @staticmethod
+    def page_link(base, page, pages, query=""):
+        """
+        :return: absolute link to the page of listing with query or None
+        if there is no such page
+        """
+        if not 1 <= page <= pages:
+            return None
+        return "{}?page={}{}".format(quote(base), page, query)
+
+    def render_json(self, base, page, pages, rows):
+        return json.dumps({
+            "path": base,
+            "page": page,
+            "pages": pages,
+            "previous": self.page_link(base, page - 1, pages, "&format=json"),
+            "next": self.page_link(base, page + 1, pages, "&format=json"),
+            "entries": [{"name": name,
+                         "type": "directory" if is_dir else "file",
+                         "size": None if is_dir else size,
+                         "mtime": int(mtime)}
+                        for name, is_dir, size, mtime in rows],
+        }).encode("utf-8")
+
+    def render_html(self, base, page, pages, rows):
+        # Links are absolute, so they are right for directory address
+        # without trailing slash too
+        title = html.escape("Index of {}".format(base))
+        parent = base.rstrip("/").rpartition("/")[0] + "/"
+        lines = ["<html><head><title>{0}</title></head><body>"
+                 "<h1>{0}</h1><pre>".format(title),
+                 '<a href="{}">../</a>'.format(html.escape(quote(parent)))]
+        for name, is_dir, size, mtime in rows:
+            name += "/" if is_dir else ""
+            modified = datetime.datetime.utcfromtimestamp(mtime) \
+                .strftime("%d-%b-%Y %H:%M")
+            lines.append('<a href="{}">{}</a>{} {} {:>12}'.format(
+                html.escape(quote(base + name)), html.escape(name),
+                " " * max(50 - len(name), 1), modified,
+                "-" if is_dir else size))
+        lines.append("</pre>")
+
+        for link, text in ((self.page_link(base, page - 1, pages), "previous"),
+                           (self.page_link(base, page + 1, pages), "next")):
+            if link is not None:
+                lines.append('<a href="{}">{}</a>'.format(html.escape(link),
+                                                          text))
+        lines.append("</body></html>\n")
+        return "\n".join(lines).encode("utf-8")
+
+
+# --------------------------- Stats ------------------------------ #
+
+class Stats:
+    """
+    Counters of the server in memory shared by all worker processes.
+    Every thread writes only to its own slot, so counters are updated
+    without locks and slots are summed when stats are read.
+    """
+
+    CODES = sorted(CODE_SPECIFICATION)
+
+    # Offsets of counters in a slot
+    REQUESTS = 0
+    SENT_BYTES = REQUESTS + len(CODES)
+    ACTIVE_CONNECTIONS = SENT_BYTES + 1
+    PATH_CACHE_HITS = ACTIVE_CONNECTIONS + 1
+    PATH_CACHE_MISSES = PATH_CACHE_HITS + 1
+    LATENCY_SUM = PATH_CACHE_MISSES + 1
+    LATENCY_COUNTS = LATENCY_SUM + 1
+    SLOT_SIZE = LATENCY_COUNTS + len(LATENCY_BUCKETS) + 1
+
+    def __init__(self, slots, path=STATS_PATH):
+        self.slots = slots
+        self.path = path
+        self.values = RawArray('q', slots * self.SLOT_SIZE)
+
+    def slot(self, index):
+        return StatsSlot(self.values, index * self.SLOT_SIZE)
+
+    def total(self, offset):
+        """
+        :param offset: offset of counter in a slot
+        :return: sum of counter over all slots
+        """
+        return sum(self.values[slot * self.SLOT_SIZE + offset]
+                   for slot in range(self.slots))
+
+    def render(self, sock_=None):
+        """
+        :param sock_: listening socket to get length of its accept queue
+        :return: stats in prometheus text format
+        """
+        lines = [
+            "# HELP httpd_requests_total Requests by status code",
+            "# TYPE httpd_requests_total counter",
+        ]
+        for i, code in enumerate(self.CODES):
+            lines.append('httpd_requests_total{{code="{}"}} {}'.format(
+                code, self.total(self.REQUESTS + i)))
+
+        hits = self.total(self.PATH_CACHE_HITS)
+        lookups = hits + self.total(self.PATH_CACHE_MISSES)
+        lines += [
+            "# HELP httpd_sent_bytes_total Bytes sent to clients",
+            "# TYPE httpd_sent_bytes_total counter",
+            "httpd_sent_bytes_total {}".format(self.total(self.SENT_BYTES)),
+            "# HELP httpd_active_connections Connections handled right now",
+            "# TYPE httpd_active_connections gauge",
+            "httpd_active_connections {}".format(
+                self.total(self.ACTIVE_CONNECTIONS)),
+            "# HELP httpd_path_cache_hits_total Hits of path cache",
+            "# TYPE httpd_path_cache_hits_total counter",
+            "httpd_path_cache_hits_total {}".format(hits),
+            "# HELP httpd_path_cache_lookups_total Lookups of path cache",
+            "# TYPE httpd_path_cache_lookups_total counter",
+            "httpd_path_cache_lookups_total {}".format(lookups),
+            "# HELP httpd_path_cache_hit_ratio Hit ratio of path cache",
+            "# TYPE httpd_path_cache_hit_ratio gauge",
+            "httpd_path_cache_hit_ratio {}".format(
+                round(hits / lookups, 4) if lookups else 0),
+        ]
+
+        accept_queue = get_accept_queue(sock_) if sock_ else None
+        if accept_queue is not None:
+            lines += [
+                "# HELP httpd_accept_queue_depth Connections waiting for "
+                "accept on the socket of the process",
+                "# TYPE httpd_accept_queue_depth gauge",
+                "httpd_accept_queue_depth {}".format(accept_queue),
+            ]
+
+        lines += [
+            "# HELP httpd_request_duration_seconds Time from accept to "
+            "sent response",
+            "# TYPE httpd_request_duration_seconds histogram",
+        ]
+        count = 0
+        for i, bucket in enumerate(LATENCY_BUCKETS + ("+Inf",)):
+            count += self.total(self.LATENCY_COUNTS + i)
+            lines.append('httpd_request_duration_seconds_bucket{{le="{}"}} '
+                         '{}'.format(bucket, count))
+        lines += [
+            "httpd_request_duration_seconds_sum {}".format(
+                self.total(self.LATENCY_SUM) / 1000000),
+            "httpd_request_duration_seconds_count {}".format(count),
+        ]
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+class StatsSlot:
+    """Counters of one thread, only this thread changes them"""
+
+    def __init__(self, values, offset):
+        self.values = values
+        self.offset = offset
+
+    def add(self, counter, value=1):
+        self.values[self.offset + counter] += value
+
+    def reset_active(self):
+        """Forget connections of died process which used the slot before"""
+        self.values[self.offset + Stats.ACTIVE_CONNECTIONS] = 0
+
+    def request_done(self, code, sent_bytes, latency):
+        """
+        :param code: HTTP code of response
+        :param sent_bytes: length of response
+        :param latency: seconds from accept to sent response
+        """
+        self.add(Stats.REQUESTS + Stats.CODES.index(code))
+        self.add(Stats.SENT_BYTES, sent_bytes)
+        self.add(Stats.LATENCY_SUM, int(latency * 1000000))
+
+        bucket = len(LATENCY_BUCKETS)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                bucket = i
+                break
+        self.add(Stats.LATENCY_COUNTS + bucket)
+
+
+def get_accept_queue(sock_):
+    """
+    :param sock_: listening socket
+    :return: number of connections waiting for accept or None if the
+    platform does not tell it
+    """
+    if TCP_INFO is None:
+        return None
+    try:
+        info = sock_.getsockopt(socket.IPPROTO_TCP, TCP_INFO, 104)
+    except OSError:
+        return None
+
+    # tcpi_unacked of listening socket is the length of accept queue
+    return struct.unpack_from("8B5I", info)[-1]
 
 
 # ------------------------ Server class -------------------------- #
 
 class GetAndHeadServer:
 
-    def __init__(self, sock_, basedir_=None):
+    def __init__(self, sock_, basedir_=None, stop_event_=None,
+                 path_cache_=None, guard_=None, stats_=None, stats_slot_=0,
+                 listing_cache_=None):
 
         # initialize inner parameters
         self.valid_requests = {
@@ -60,14 +458,21 @@ class GetAndHeadServer:
         }
         self.socket_ = sock_
         self.basedir = basedir_
+        self.stop_event = stop_event_
+        self.path_cache = path_cache_ if path_cache_ is not None \
+            else PathCache()
+        self.guard = guard_ if guard_ is not None else ConnectionGuard()
+        self.stats = stats_ if stats_ is not None else Stats(1)
+        self.stats_slot = self.stats.slot(stats_slot_)
+        self.stats_slot.reset_active()
+        self.listing_cache = listing_cache_
+        self.response_code = None
         self.serve_forever()
 
-    def do_method(self, address, method, repeated=False):
+    def do_method(self, address, method):
         """
         :param address: real_address of file
         :param method: GET or HEAD
-        :param repeated: if request target is a directory, try to
-        find index.html in it with parameter repeated=True
         :return: return response with headers and file
         """
         try:
@@ -75,18 +480,9 @@ class GetAndHeadServer:
                 return self.return_response(OK, content.read(),
                                             self.parse_type(address),
                                             method)
-        except FileNotFoundError:
-            if repeated:
-                raise FileNotFoundError
-            return self.return_response(NOT_FOUND)
-        except IsADirectoryError:
-            try:
-                return self.do_method(address + "/index.html", method,
-                                      repeated=True)
-            except FileNotFoundError:
-                return self.return_response(FORBIDDEN)
 
-        except NotADirectoryError:
+        # File was removed or replaced after its path had been cached
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
             return self.return_response(NOT_FOUND)
 
     def do_GET(self, address):
@@ -108,17 +504,52 @@ class GetAndHeadServer:
         except ValueError:
             return self.return_response(BAD_REQUEST)
 
-        real_address = self.validate_address(address.lstrip("/"))
-        if not real_address:
-            return self.return_response(FORBIDDEN)
-
         method = self.valid_requests.get(req_type.strip())
 
+        if self.stats.path and address == self.stats.path and method:
+            return self.return_response(OK, self.stats.render(self.socket_),
+                                        STATS_CONTENT_TYPE, req_type.strip())
+
         if not method:
             return self.return_response(METHOD_NOT_ALLOWED)
 
+        code, real_address = self.validate_address(address)
+        if code != OK:
+            return self.return_response(code)
+
+        if real_address.endswith(os.sep):
+            return self.do_listing(real_address, address, req_type.strip())
+
         return method(real_address)
 
+    def do_listing(self, directory, address, method):
+        """
+        :param directory: real address of directory ending with separator
+        :param address: address in request with query string
+        :param method: GET or HEAD
+        :return: response with page of directory listing
+        """
+        target, _, query = address.partition("?")
+        params = parse_qs(query)
+        try:
+            page = int(params.get("page", ["1"])[0])
+        except ValueError:
+            return self.return_response(BAD_REQUEST)
+        if page < 1:
+            return self.return_response(BAD_REQUEST)
+
+        base = unquote(target.split("#", 1)[0]).rstrip("/") + "/"
+        fmt = params.get("format", ["html"])[0]
+        try:
+            rendered = self.listing_cache.get_page(directory, base, page, fmt)
+        except OSError:
+            return self.return_response(NOT_FOUND)
+        if rendered is None:
+            return self.return_response(NOT_FOUND)
+
+        content, content_type = rendered
+        return self.return_response(OK, content, content_type, method)
+
     @staticmethod
     def get_current_date():
         """
@@ -148,6 +579,7 @@ class GetAndHeadServer:
         :param type_of_request: GET or HEAD
         :return: byte array with valid response
         """
+        self.response_code = code
         response = "{} {} {}\r\n".format(HTTP_VERSION, code,
                                          CODE_SPECIFICATION[code])
         response += "Date: {}\r\n".format(self.get_current_date())
@@ -168,44 +600,352 @@ class GetAndHeadServer:
 
     def validate_address(self, address):
         """
-        Method to prevent path traversal
+        Method to prevent path traversal, resolution is cached
         :param address: address in request
-        :return: valid address if there is one
+        :return: tuple with HTTP code and real address of file to return
         """
-        real_address = os.path.realpath(address)
-        if real_address.startswith(self.basedir):
-            if '?' in address:
-                return address[:address.find('?')]
+        target = address.split("?", 1)[0]
+        resolution = self.path_cache.get(target)
+        if resolution is None:
+            self.stats_slot.add(Stats.PATH_CACHE_MISSES)
+            resolution = self.resolve_address(target)
+            self.path_cache.set(target, resolution)
+        else:
+            self.stats_slot.add(Stats.PATH_CACHE_HITS)
+        return resolution
+
+    def resolve_address(self, target):
+        """
+        :param target: address in request without query string
+        :return: tuple with HTTP code and real address of file to return,
+        for directories it is address of index file in them or, if listing
+        of directories is on, address of directory ending with separator
+        """
+        path = unquote(target.split("#", 1)[0]).lstrip("/")
+        if "\0" in path:
+            return BAD_REQUEST, None
 
-            # Replace escaped characters
-            percent_chars = re.findall(ESCAPE_PATTERN, address)
-            for percent_char in percent_chars:
-                address = address.replace(percent_char,
-                                          chr(int(percent_char[1:], 16)))
+        # Check escaping of document root on the decoded path
+        real_address = os.path.realpath(path)
+        if real_address != self.basedir and \
+                not real_address.startswith(self.basedir + os.sep):
+            return FORBIDDEN, None
 
-            return address
+        try:
+            mode = os.stat(real_address).st_mode
+        except OSError:
+            return NOT_FOUND, None
+
+        if stat.S_ISDIR(mode):
+            index_address = os.path.join(real_address, INDEX_FILE)
+            if os.path.isfile(index_address):
+                return OK, index_address
+            if self.listing_cache is not None:
+                return OK, os.path.join(real_address, "")
+            return FORBIDDEN, None
+
+        # Slash after filename means a directory
+        if stat.S_ISREG(mode) and not path.endswith("/"):
+            return OK, real_address
+        return NOT_FOUND, None
+
+    def read_request(self, conn):
+        """
+        :param conn: socket of accepted connection
+        :return: request in bytes format
+
+        Headers must be received before the deadline, so a client which
+        sends a request by small parts cannot hold a thread for longer
+        """
+        deadline = time.monotonic() + self.guard.header_timeout
+        data = b""
+        while len(data) <= MAX_REQUEST_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise socket.timeout("Headers are not received in time")
+            conn.settimeout(timeout)
+
+            new_data = conn.recv(CHUNK_SIZE)
+            data += new_data
+
+            # Search end of headers only in the last part of request
+            tail = data[-len(new_data) - 3:]
+            if not new_data or any(end in tail for end in END_OF_HEADERS):
+                break
+        return data
+
+    def handle_connection(self, conn):
+        """
+        :param conn: socket of accepted connection
+        """
+        try:
+            data = self.read_request(conn)
+        except socket.timeout:
+            logging.info("Request timeout")
+            response = self.return_response(REQUEST_TIMEOUT)
+        else:
+            if len(data) > MAX_REQUEST_SIZE:
+                response = self.return_response(BAD_REQUEST)
+            else:
+                response = self.handle_request(data)
+
+        # Slow reader cannot hold a thread longer than write timeout
+        conn.settimeout(self.guard.write_timeout)
+        conn.sendall(response)
+        return response
 
     def serve_forever(self):
-        """Function to start server until it will be manually closed"""
-        while True:
+        """
+        Function to start server until it will be manually closed
+        or stop_event will be set
+        """
+        while not (self.stop_event and self.stop_event.is_set()):
             try:
                 conn, address = self.socket_.accept()
+            except socket.timeout:
+                continue
 
-                data = b""
-                while True:
-                    new_data = conn.recv(CHUNK_SIZE)
-                    data += new_data
-                    if not new_data \
-                            or re.match(PATTERN_END_OF_REQUEST, new_data):
-                        break
+            accepted = time.monotonic()
+            self.stats_slot.add(Stats.ACTIVE_CONNECTIONS)
 
-                response = self.handle_request(data)
-
-                conn.send(response)
+            ip = address[0]
+            allowed = self.guard.acquire(ip)
+            try:
+                if allowed:
+                    response = self.handle_connection(conn)
+                else:
+                    logging.info("Too many connections from {}".format(ip))
+                    response = self.return_response(SERVICE_UNAVAILABLE)
+                    conn.settimeout(self.guard.write_timeout)
+                    conn.sendall(response)
+                self.stats_slot.request_done(self.response_code, len(response),
+                                             time.monotonic() - accepted)
+
+            except OSError as e:
+                logging.info("Connection from {} dropped: {}".format(ip, e))
+            except Exception as e:
+                logging.exception("Cannot handle request: {}".format(e))
+            finally:
+                if allowed:
+                    self.guard.release(ip)
+                self.stats_slot.add(Stats.ACTIVE_CONNECTIONS, -1)
                 conn.close()
 
+
+# ---------------------- Workers and master ---------------------- #
+
+def create_socket(port, reuse_port=False):
+    """
+    :param port: port to listen
+    :param reuse_port: set SO_REUSEPORT to let several processes bind
+    their own socket on the same port
+    :return: listening socket
+    """
+    sock_ = socket.socket()
+    sock_.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if reuse_port:
+        sock_.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    sock_.bind(('', port))
+    sock_.listen(LISTEN_BACKLOG)
+    return sock_
+
+
+def start_threads(sock_, basedir_, options, stop_event=None,
+                  stats=None, first_slot=0):
+    """
+    :param sock_: listening socket
+    :param basedir_: real path of document root
+    :param options: options from OptionsParser
+    :param stop_event: threading.Event to stop threads gracefully
+    :param stats: Stats shared by all processes
+    :param first_slot: slot in stats of the first thread of the process
+    :return: list of started threads
+
+    Threads of one process share cache of paths and connection guard
+    """
+    path_cache = PathCache(ttl=options.path_cache_ttl)
+    guard = ConnectionGuard(header_timeout=options.header_timeout,
+                            write_timeout=options.write_timeout,
+                            max_per_ip=options.max_per_ip)
+    if stats is None:
+        stats = Stats(options.workers, options.stats_path)
+    listing_cache = ListingCache(page_size=options.autoindex_page_size,
+                                 ttl=options.path_cache_ttl) \
+        if options.autoindex else None
+
+    threads = []
+    for i in range(options.workers):
+        thread = Thread(target=GetAndHeadServer,
+                        args=(sock_, basedir_, stop_event, path_cache, guard,
+                              stats, first_slot + i, listing_cache))
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+def serve_in_process(sock_, basedir_, options, stats, first_slot):
+    """
+    :param sock_: listening socket of the worker process
+    :param basedir_: real path of document root
+    :param options: options from OptionsParser
+    :param stats: Stats shared by all processes
+    :param first_slot: slot in stats of the first thread of the process
+
+    Function runs threads of the worker process until it gets SIGTERM or
+    SIGINT. Then threads finish current requests and the process exits.
+    The socket is inherited from the master, so closing it here does not
+    drop connections waiting in its accept queue.
+    """
+    stop_event = Event()
+    stop_requested = []
+
+    # Handler only sets a flag: setting the event right in the handler can
+    # deadlock on the event lock which is held by interrupted main thread
+    def stop(signum, frame):
+        stop_requested.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    # Threads wake up periodically to check stop_event
+    sock_.settimeout(ACCEPT_TIMEOUT)
+    threads = start_threads(sock_, basedir_, options, stop_event,
+                            stats, first_slot)
+
+    while not stop_requested:
+        time.sleep(ACCEPT_TIMEOUT)
+    stop_event.set()
+
+    for thread in threads:
+        thread.join()
+    sock_.close()
+
+
+class PreforkMaster:
+    """
+    Master process which forks worker processes, restarts died ones and
+    gracefully reloads all of them on SIGHUP
+    """
+
+    def __init__(self, basedir_, options):
+        self.basedir = basedir_
+        self.options = options
+        self.port = options.port
+        self.processes = options.processes
+
+        # Listening sockets are created by the master and inherited by
+        # workers of all generations, so on reload the new worker accepts
+        # connections queued on the socket of the old one instead of the
+        # kernel resetting them. With SO_REUSEPORT worker of every index
+        # has its own socket and kernel balances connections between them,
+        # otherwise all workers accept from one socket
+        self.reuse_port = SO_REUSEPORT is not None
+        if self.reuse_port:
+            self.sockets = [create_socket(self.port, reuse_port=True)
+                            for _ in range(self.processes)]
+        else:
+            self.sockets = [create_socket(self.port)] * self.processes
+
+        # Slots for threads of two generations, so workers of the old
+        # generation do not write to slots of the new one during reload
+        self.stats = Stats(2 * self.processes * options.workers,
+                           options.stats_path)
+
+        self.children = {}
+        self.generation = 0
+        self.reload_requested = False
+        self.stopping = False
+
+    def spawn_worker(self, index):
+        """
+        :param index: number of the worker in its generation
+
+        Fork new worker process of current generation
+        """
+        first_slot = ((self.generation % 2) * self.processes + index) * \
+            self.options.workers
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                serve_in_process(self.sockets[index], self.basedir,
+                                 self.options, self.stats, first_slot)
             except Exception as e:
-                raise e
+                logging.exception("Worker {} failed: {}".format(os.getpid(), e))
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+
+        logging.info("Worker {} started".format(pid))
+        self.children[pid] = (self.generation, index)
+
+    def reload(self):
+        """Start new generation of workers and stop the old one"""
+        old_workers = list(self.children)
+        self.generation += 1
+        for i in range(self.processes):
+            self.spawn_worker(i)
+        for pid in old_workers:
+            self.kill_worker(pid)
+
+    @staticmethod
+    def kill_worker(pid):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def reap_workers(self):
+        """Wait for died workers and restart them if they are not old"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+
+            generation, index = self.children.pop(pid, (None, None))
+            if generation == self.generation and not self.stopping:
+                logging.error("Worker {} died with status {}, "
+                              "restarting".format(pid, status))
+                self.spawn_worker(index)
+
+    def serve_forever(self):
+        """Function to run workers until master gets SIGTERM or SIGINT"""
+
+        def reload(signum, frame):
+            self.reload_requested = True
+
+        def stop(signum, frame):
+            self.stopping = True
+
+        signal.signal(signal.SIGHUP, reload)
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        for i in range(self.processes):
+            self.spawn_worker(i)
+
+        while not self.stopping:
+            if self.reload_requested:
+                self.reload_requested = False
+                logging.info("Reloading workers")
+                self.reload()
+            self.reap_workers()
+            time.sleep(MASTER_POLL_INTERVAL)
+
+        for pid in self.children:
+            self.kill_worker(pid)
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            self.children.pop(pid, None)
+        for sock_ in set(self.sockets):
+            sock_.close()
 
 
 # ---------------------------- Main ----------------------------- #
@@ -218,6 +958,18 @@ if __name__ == "__main__":
     op.add_option("-l", "--log", action="store", default=None)
     op.add_option("-p", "--port", action="store", type=int, default=8000)
     op.add_option("-w", "--workers", action="store", type=int, default=2)
+    op.add_option("-P", "--processes", action="store", type=int, default=0)
+    op.add_option("--path_cache_ttl", action="store", type=float,
+                  default=PATH_CACHE_TTL)
+    op.add_option("--header_timeout", action="store", type=float,
+                  default=HEADER_TIMEOUT)
+    op.add_option("--write_timeout", action="store", type=float,
+                  default=WRITE_TIMEOUT)
+    op.add_option("--max_per_ip", action="store", type=int, default=0)
+    op.add_option("--stats_path", action="store", default=STATS_PATH)
+    op.add_option("--autoindex", action="store_true", default=False)
+    op.add_option("--autoindex_page_size", action="store", type=int,
+                  default=LISTING_PAGE_SIZE)
     op.add_option("-r", "--root_dir", action="store", default=DOCUMENT_ROOT)
     (opts, args) = op.parse_args()
 
@@ -226,14 +978,13 @@ if __name__ == "__main__":
                         format='[%(asctime)s] %(levelname).1s %(message)s',
                         datefmt='%Y.%m.%d %H:%M:%S')
 
-    # Socket
-    sock = socket.socket()
-    sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
     basedir = os.path.realpath(".") + opts.root_dir
-    sock.bind(('', opts.port))
-    sock.listen(1024)
+
+    # Processes, each of them runs its own threads
+    if opts.processes > 0:
+        PreforkMaster(basedir, opts).serve_forever()
 
     # Threads
-    for i in range(opts.workers):
-        thread = Thread(target=GetAndHeadServer, args=(sock, basedir))
-        thread.start()
+    else:
+        sock = create_socket(opts.port)
+        start_threads(sock, basedir, opts)
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
+import json
 import re
 import socket
+import time
 import http.client as httplib
 import unittest
 
@@ -125,6 +127,13 @@ class HttpServer(unittest.TestCase):
         data = r.read()
         self.assertIn(int(r.status), (400, 403, 404))
 
+    def test_document_root_escaping_urlencoded(self):
+        """urlencoded document root escaping forbidden"""
+        self.conn.request("GET", "/httptest/%2e%2e/%2e%2e/%2e%2e/%2e%2e/%2e%2e/%2e%2e/etc/passwd")
+        r = self.conn.getresponse()
+        data = r.read()
+        self.assertIn(int(r.status), (400, 403, 404))
+
     def test_file_with_dot_in_name(self):
         """file with two dots in name"""
         self.conn.request("GET", "/httptest/text..txt")
@@ -142,6 +151,13 @@ class HttpServer(unittest.TestCase):
         data = r.read()
         self.assertIn(int(r.status), (400, 405))
 
+    def test_post_method_not_found(self):
+        """post method forbidden for missing file"""
+        self.conn.request("POST", "/httptest/smdklcdsmvdfjnvdfjvdfvdfvdsfssdmfdsdfsd.html")
+        r = self.conn.getresponse()
+        data = r.read()
+        self.assertEqual(int(r.status), 405)
+
     def test_head_method(self):
         """head method support"""
 
@@ -171,6 +187,17 @@ class HttpServer(unittest.TestCase):
         else:
             self.assertIn(int(code), (400, 405))
 
+    def test_stats(self):
+        """stats endpoint in prometheus format"""
+        self.conn.request("GET", "/__stats")
+        r = self.conn.getresponse()
+        data = r.read()
+        ctype = r.getheader("Content-Type")
+        self.assertEqual(int(r.status), 200)
+        self.assertTrue(ctype.startswith("text/plain"))
+        self.assertIn(b'httpd_requests_total{code="200"}', data)
+        self.assertIn(b'httpd_request_duration_seconds_count', data)
+
     def test_filetype_html(self):
         """Content-Type for .html"""
         self.conn.request("GET", "/httptest/dir2/page.html")
@@ -268,10 +295,109 @@ class HttpServer(unittest.TestCase):
         self.assertEqual(ctype, "application/x-shockwave-flash")
 
 
+class ConnectionGuardServer(unittest.TestCase):
+    """Server started with --header_timeout 1 --max_per_ip 1 in one process"""
+    host = "localhost"
+    port = 8001
+
+    def setUp(self):
+        try:
+            socket.create_connection((self.host, self.port), timeout=1).close()
+        except OSError:
+            self.skipTest("server with connection limits is not running")
+        # Server releases the checking connection after it is closed
+        time.sleep(0.2)
+
+    def test_slow_headers(self):
+        """slow client gets request timeout"""
+        s = socket.create_connection((self.host, self.port), timeout=5)
+        start = time.monotonic()
+        try:
+            # Every byte comes before timeout, but headers are not complete
+            for char in b"GET ":
+                s.send(bytes([char]))
+                time.sleep(0.2)
+            data = s.recv(1024)
+        finally:
+            s.close()
+        self.assertTrue(data.startswith(b"HTTP/1.1 408"))
+        self.assertLess(time.monotonic() - start, 1.5)
+
+    def test_connections_per_ip(self):
+        """extra connection from the same ip is rejected"""
+        held = socket.create_connection((self.host, self.port), timeout=5)
+        try:
+            held.send(b"GET /httptest/dir2/page.html HTTP/1.0\r\n")
+            time.sleep(0.2)
+            # Extra connection is answered at once without reading request
+            s = socket.create_connection((self.host, self.port), timeout=5)
+            data = s.recv(1024)
+            s.close()
+            self.assertTrue(data.startswith(b"HTTP/1.1 503"))
+        finally:
+            held.close()
+
+
+class AutoindexServer(unittest.TestCase):
+    """Server started with --autoindex --autoindex_page_size 2"""
+    host = "localhost"
+    port = 8002
+
+    def setUp(self):
+        try:
+            socket.create_connection((self.host, self.port), timeout=1).close()
+        except OSError:
+            self.skipTest("server with autoindex is not running")
+        self.conn = httplib.HTTPConnection(self.host, self.port, timeout=10)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def get(self, path):
+        self.conn.request("GET", path)
+        r = self.conn.getresponse()
+        return r, r.read()
+
+    def test_listing_without_slash(self):
+        """listing links of directory without trailing slash"""
+        r, data = self.get("/httptest/dir1")
+        self.assertEqual(int(r.status), 200)
+        self.assertIn(b'<a href="/httptest/">../</a>', data)
+        self.assertIn(b'<a href="/httptest/dir1/dir12/">dir12/</a>', data)
+
+    def test_listing_pages(self):
+        """listing is split to pages"""
+        r, data = self.get("/httptest/wikipedia_russia_files/?page=2")
+        self.assertEqual(int(r.status), 200)
+        entries = re.findall(b'href="/httptest/wikipedia_russia_files/[^?"]+"', data)
+        self.assertEqual(len(entries), 2)
+        self.assertIn(b'<a href="/httptest/wikipedia_russia_files/?page=1">previous</a>', data)
+        self.assertIn(b'<a href="/httptest/wikipedia_russia_files/?page=3">next</a>', data)
+
+        r, data = self.get("/httptest/wikipedia_russia_files/?page=1000")
+        self.assertEqual(int(r.status), 404)
+
+    def test_listing_json(self):
+        """listing in json format"""
+        r, data = self.get("/httptest/wikipedia_russia_files/?format=json")
+        listing = json.loads(data.decode("utf-8"))
+        self.assertEqual(int(r.status), 200)
+        self.assertEqual(r.getheader("Content-Type"), "application/json")
+        self.assertEqual(listing["page"], 1)
+        self.assertEqual(len(listing["entries"]), 2)
+        self.assertIsNone(listing["previous"])
+        self.assertEqual(listing["next"], "/httptest/wikipedia_russia_files/?page=2&format=json")
+
+        r, data = self.get(listing["next"])
+        self.assertEqual(json.loads(data.decode("utf-8"))["page"], 2)
+
+
 loader = unittest.TestLoader()
 suite = unittest.TestSuite()
 a = loader.loadTestsFromTestCase(HttpServer)
 suite.addTest(a)
+suite.addTest(loader.loadTestsFromTestCase(ConnectionGuardServer))
+suite.addTest(loader.loadTestsFromTestCase(AutoindexServer))
 
 
 class NewResult(unittest.TextTestResult):
@@ -40,6 +40,7 @@ Git version: %{git_version} (branch: %{git_branch})
 
 
 %{__install} -pD -m 644 server/%{name}.py %{buildroot}/%{__bindir}/%{name}.py
+%{__install} -pD -m 644 server/%{name}_asgi.py %{buildroot}/%{__bindir}/%{name}_asgi.py
 %{__install} -pD -m 644 server/config_%{name}.json %{buildroot}/%{__etcdir}/config_%{name}.json
 %{__install} -pD -m 644 server/%{name}.ini %{buildroot}/%{__etcdir}/%{name}.ini
 %{__install} -pD -m 644 %{name}.service %{buildroot}/%{__systemddir}/%{name}.service
@@ -1,11 +1,29 @@
+import bisect
+import fcntl
+import hashlib
 import json
 import logging
+import mmap
 import os
-import requests
+import random
 import socket
+import struct
 import sys
+import threading
+import time
 
-from urllib import quote
+from array import array
+from collections import OrderedDict
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+try:
+    from Queue import Full, Queue
+except ImportError:
+    from queue import Full, Queue
 
 # -------------------------- Constants --------------------------- #
 
@@ -14,33 +32,104 @@ IPINFO_URL = "http://ipinfo.io/{ip_address}"
 OPEN_WEATHER_URL = "http://api.openweathermap.org/data/2.5/weather?" \
                    "q={city},{country}&APPID={token}&lang=ru&units=metric"
 
-TOKEN = os.environ.get("OPEN_WEATHER_TOKEN")
-if not TOKEN:
-    sys.exit("Provide OPEN_WEATHER_TOKEN for correct work of application")
+# Token is read from OPEN_WEATHER_TOKEN environment variable by create_app
+TOKEN = None
 
+CONFIG_FILE = "/usr/local/etc/config_ip2w.json"
 LOG_FILE = None
 
+CACHE_BACKEND = "local"
+MEMCACHED_ADDRESS = "127.0.0.1:11211"
+LOCAL_CACHE_SIZE = 10000
+
+# Ip almost never changes its city, weather changes slowly
+GEO_CACHE_TTL = 24 * 60 * 60
+WEATHER_CACHE_TTL = 10 * 60
+NEGATIVE_CACHE_TTL = 5 * 60
+
+# Weather older than WEATHER_CACHE_TTL is served for WEATHER_STALE_TTL
+# more while it is refreshed in background
+WEATHER_STALE_TTL = 30 * 60
+REFRESH_WORKERS = 2
+REFRESH_QUEUE_SIZE = 100
+REFRESH_INTERVAL = 10
+# Popular cities are refreshed when their weather gets this part of ttl old
+REFRESH_AHEAD = 0.8
+POPULAR_CITIES = 1000
+
+GEO_DB_FILE = None
+GEO_DB_CHECK_INTERVAL = 60
+GEO_DB_FORMAT = "ranges"
+
+# Columns of country and city in rows of geo database formats, columns
+# of ip2location are ip_from,ip_to,country_code,country_name,region,city
+# and unknown values are "-"
+GEO_DB_FORMATS = {
+    "ranges": (2, 3),
+    "ip2location": (2, 5),
+}
+
+# Compact arrays of 32-bit integers for ip ranges
+INT32_TYPECODE = "I" if array("I").itemsize >= 4 else "L"
+MAX_IPV4 = 0xFFFFFFFF
+
+IPINFO = "ipinfo"
+OPEN_WEATHER = "openweathermap"
+
+CONNECT_TIMEOUT = 1
+READ_TIMEOUT = 3
+POOL_SIZE = 10
+RETRIES = 2
+RETRY_BACKOFF = 0.1
+RETRY_BACKOFF_MAX = 1
+BREAKER_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30
+
+MAX_BATCH_SIZE = 1000
+
+# Token buckets of clients in requests per second and of the whole service
+# in lookups to upstreams per second, rate 0 turns the limit off
+RATE_LIMIT_FILE = "/dev/shm/ip2w_rate_limit"
+RATE_LIMIT_SLOTS = 65536
+CLIENT_RATE = 10
+CLIENT_BURST = 20
+GLOBAL_RATE = 100
+GLOBAL_BURST = 200
+
 OK = 200
 BAD_REQUEST = 400
+METHOD_NOT_ALLOWED = 405
+TOO_MANY_REQUESTS = 429
 BAD_GATEWAY = 502
 
 ERRORS = {
     OK: "OK",
     BAD_REQUEST: "Bad Request",
+    METHOD_NOT_ALLOWED: "Method Not Allowed",
+    TOO_MANY_REQUESTS: "Too Many Requests",
     BAD_GATEWAY: "Bad Gateway",
 }
 
 # --------------------- Configuration file ----------------------- #
 
+CONFIG = {}
 
-try:
-    with open("/usr/local/etc/config_ip2w.json") as json_file:
-        CONFIG = json.load(json_file)
-except IOError:
-    pass
+# Settings which can be changed in configuration file
+CONFIG_KEYS = (
+    "IPINFO_URL", "OPEN_WEATHER_URL", "LOG_FILE", "CACHE_BACKEND",
+    "MEMCACHED_ADDRESS", "LOCAL_CACHE_SIZE", "GEO_CACHE_TTL",
+    "WEATHER_CACHE_TTL", "NEGATIVE_CACHE_TTL", "WEATHER_STALE_TTL",
+    "REFRESH_WORKERS", "REFRESH_QUEUE_SIZE", "REFRESH_INTERVAL",
+    "REFRESH_AHEAD", "POPULAR_CITIES", "GEO_DB_FILE", "GEO_DB_CHECK_INTERVAL",
+    "GEO_DB_FORMAT", "CONNECT_TIMEOUT", "READ_TIMEOUT", "POOL_SIZE", "RETRIES",
+    "RETRY_BACKOFF", "RETRY_BACKOFF_MAX", "BREAKER_THRESHOLD",
+    "BREAKER_RESET_TIMEOUT", "MAX_BATCH_SIZE", "RATE_LIMIT_FILE",
+    "RATE_LIMIT_SLOTS", "CLIENT_RATE", "CLIENT_BURST", "GLOBAL_RATE",
+    "GLOBAL_BURST",
+)
 
-if locals().get("CONFIG"):
-    LOG_FILE = CONFIG.get("LOG_FILE")
+# Default settings, every configuration file is applied on top of them
+DEFAULTS = dict((name, globals()[name]) for name in CONFIG_KEYS)
 
 
 # -------------------------- Exceptions -------------------------- #
@@ -49,11 +138,592 @@ class NoWeatherException(Exception):
     pass
 
 
-# -------------------- Logging configuration --------------------- #
+class UpstreamException(Exception):
+    """Upstream failed after all retries or its circuit is open"""
+    pass
+
+
+class RateLimitedException(Exception):
+    """Lookups of the service in upstreams exceed the global rate limit"""
+    pass
+
+
+# --------------------------- Caches ----------------------------- #
+
+class LocalCache(object):
+    """
+    In-process LRU cache with time to live of entries. Every uwsgi worker
+    has its own copy of the cache.
+    """
+
+    def __init__(self, max_size=LOCAL_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: key of cached value
+        :return: value or None if there is no fresh value
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                return None
+            self.entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        """
+        :param key: key of cached value
+        :param value: value to cache
+        :param ttl: time to live of value in seconds
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            if len(self.entries) >= self.max_size:
+                self.entries.popitem(last=False)
+            self.entries[key] = (time.time() + ttl, value)
+
+
+class MemcachedCache(object):
+    """
+    Cache shared by all uwsgi workers and hosts in memcached. Errors of
+    memcached are logged and treated as cache misses.
+    """
+
+    def __init__(self, address=MEMCACHED_ADDRESS):
+        import memcache
+        self.client = memcache.Client([address])
+
+    def get(self, key):
+        try:
+            return self.client.get(key)
+        except Exception as e:
+            logging.exception("Cannot read from memcached: %s" % e)
+
+    def set(self, key, value, ttl):
+        try:
+            self.client.set(key, value, time=int(ttl))
+        except Exception as e:
+            logging.exception("Cannot write to memcached: %s" % e)
+
+
+class NullCache(object):
+    """Cache which keeps nothing, every lookup goes to upstream"""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+
+CACHE_BACKENDS = {
+    "local": lambda: LocalCache(LOCAL_CACHE_SIZE),
+    "memcached": lambda: MemcachedCache(MEMCACHED_ADDRESS),
+    "none": NullCache,
+}
+
+# Objects below are created again by create_app with configured settings
+CACHE = LocalCache()
+
+
+def cache_key(prefix, *parts):
+    """
+    :param prefix: kind of cached value
+    :param parts: parts of key, strings in any encoding
+    :return: key safe for memcached
+    """
+    digest = hashlib.md5(u"\t".join(
+        part.decode("utf-8") if isinstance(part, bytes) else part
+        for part in parts).encode("utf-8")).hexdigest()
+    return "ip2w:{prefix}:{digest}".format(prefix=prefix, digest=digest)
+
+
+# ----------------------- Geo database --------------------------- #
+
+def ip_to_int(ip_address):
+    """
+    :param ip_address: ip address in dotted format
+    :return: ip address as integer
+    """
+    return struct.unpack("!I", socket.inet_aton(ip_address))[0]
+
+
+class GeoDatabase(object):
+    """
+    Local database of ip ranges loaded from csv file with rows
+    start_ip,end_ip,country,city where ips are dotted or integers, or
+    from ip2location csv file with city. Only ipv4 ranges are loaded.
+    Ranges are kept sorted in arrays of integers and found by binary
+    search. The file is reloaded without restart when its mtime changes.
+    """
+
+    def __init__(self, path, check_interval=GEO_DB_CHECK_INTERVAL,
+                 db_format=GEO_DB_FORMAT):
+        self.path = path
+        self.check_interval = check_interval
+        self.country_column, self.city_column = GEO_DB_FORMATS[db_format]
+        self.mtime = None
+        self.next_check = 0
+        self.data = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def parse_ip(value):
+        return int(value) if value.isdigit() else ip_to_int(value)
+
+    def load(self):
+        """Read the file and replace ranges in memory at once"""
+        rows = []
+        columns = max(self.country_column, self.city_column) + 1
+        with open(self.path, "rb") as csv_file:
+            for line in csv_file:
+                parts = [part.strip().strip('"') for part in
+                         line.decode("utf-8").split(",")]
+                if len(parts) < columns or ":" in parts[0]:
+                    continue
+                try:
+                    start, end = (self.parse_ip(parts[0]),
+                                  self.parse_ip(parts[1]))
+                except (ValueError, socket.error):
+                    continue
+                # Ranges of ipv6 and broken rows do not fit 32-bit arrays
+                if not 0 <= start <= end <= MAX_IPV4:
+                    continue
+                country, city = [
+                    "" if part == "-" else part for part in
+                    (parts[self.country_column], parts[self.city_column])]
+                rows.append((start, end, country, city))
+        rows.sort()
+
+        starts, ends = array(INT32_TYPECODE), array(INT32_TYPECODE)
+        location_ids = array(INT32_TYPECODE)
+        locations, location_index = [], {}
+        for start, end, country, city in rows:
+            location = (city or None, country or None)
+            if location not in location_index:
+                location_index[location] = len(locations)
+                locations.append(location)
+            starts.append(start)
+            ends.append(end)
+            location_ids.append(location_index[location])
+
+        self.data = (starts, ends, location_ids, locations)
+        logging.info("Geo database %s loaded: %s ranges" %
+                     (self.path, len(starts)))
+
+    def check_reload(self):
+        """Reload the file if it was changed, old ranges stay on errors"""
+        if time.time() < self.next_check:
+            return
+        with self.lock:
+            if time.time() < self.next_check:
+                return
+            self.next_check = time.time() + self.check_interval
+            try:
+                mtime = os.stat(self.path).st_mtime
+                if mtime != self.mtime:
+                    self.load()
+                    self.mtime = mtime
+            except (IOError, OSError, ValueError, OverflowError) as e:
+                logging.exception("Cannot load geo database: %s" % e)
+
+    def lookup(self, ip_address):
+        """
+        :param ip_address: ip address in dotted format
+        :return: city and country or None if ip is not in database
+        """
+        self.check_reload()
+        data = self.data
+        if data is None:
+            return None
+
+        starts, ends, location_ids, locations = data
+        ip = ip_to_int(ip_address)
+        i = bisect.bisect_right(starts, ip) - 1
+        if i >= 0 and ip <= ends[i]:
+            return locations[location_ids[i]]
+        return None
+
+
+GEO_DB = None
+
+
+# ----------------------- Upstream calls ------------------------- #
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker of one upstream. After threshold failures in a row
+    the circuit opens and requests fail fast. After reset_timeout one
+    request is let through, its success closes the circuit.
+    """
+
+    def __init__(self, name, threshold=BREAKER_THRESHOLD,
+                 reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        :return: True if request to upstream can be sent
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.reset_timeout:
+                # Half-open state, next failure opens circuit again
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logging.error("Circuit of %s is open" % self.name)
+                self.opened_at = time.time()
+
+
+BREAKERS = {
+    IPINFO: CircuitBreaker(IPINFO),
+    OPEN_WEATHER: CircuitBreaker(OPEN_WEATHER),
+}
+
+SESSION = {"pid": None, "session": None}
+
+
+def get_session():
+    """
+    :return: requests.Session of current uwsgi worker, its connections
+    are kept alive between requests
+
+    requests is imported here with the first request to upstream, so
+    workers which find everything in cache never import it
+    """
+    if SESSION["pid"] != os.getpid():
+        import requests
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE,
+                                                pool_maxsize=POOL_SIZE)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        SESSION["pid"], SESSION["session"] = os.getpid(), session
+    return SESSION["session"]
+
+
+def fetch_json(upstream, url):
+    """
+    :param upstream: name of upstream for its circuit breaker
+    :param url: url to get
+    :return: decoded json of response
+
+    Function retries failed requests with exponential backoff and jitter,
+    when all retries fail or circuit is open UpstreamException is raised,
+    RateLimitedException is raised over the global rate limit
+    """
+    # The limit is checked first, so rejected lookups do not take the
+    # single trial request of half open circuit
+    if upstream_limited(upstream):
+        raise RateLimitedException("Rate limit of %s is exceeded" % upstream)
+    breaker = BREAKERS[upstream]
+    if not breaker.allow():
+        raise UpstreamException("Circuit of %s is open" % upstream)
+
+    session = get_session()
+    import requests
+    for attempt in range(RETRIES + 1):
+        try:
+            response = session.get(
+                url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            if response.status_code >= 500 or response.status_code == 429:
+                raise requests.exceptions.HTTPError(
+                    "%s returned %s" % (upstream, response.status_code))
+            result = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.info("Request to %s failed: %s" % (upstream, e))
+            if attempt == RETRIES:
+                breaker.failure()
+                raise UpstreamException("%s failed: %s" % (upstream, e))
+            time.sleep(random.uniform(
+                0, min(RETRY_BACKOFF * 2 ** attempt, RETRY_BACKOFF_MAX)))
+        else:
+            breaker.success()
+            return result
+
+
+# ----------------------- Background refresh --------------------- #
+
+class WeatherRefresher(object):
+    """
+    Background refresh of weather in a uwsgi worker. Requests of cities
+    are counted, the most popular cities are refreshed before their
+    weather expires and stale weather is refreshed on request. Number of
+    refreshing threads and queue of cities are bounded, when the queue
+    is full stale weather is served until a later request.
+    """
+
+    def __init__(self, workers=REFRESH_WORKERS, queue_size=REFRESH_QUEUE_SIZE,
+                 interval=REFRESH_INTERVAL, popular=POPULAR_CITIES):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.interval = interval
+        self.popular = popular
+        self.hits = {}
+        self.pending = set()
+        self.queue = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start threads in current process, uwsgi workers get no threads
+        of master after fork"""
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.hits, self.pending = {}, set()
+            self.queue = Queue(self.queue_size)
+
+        for target in [self.scan_popular] + [self.refresh] * self.workers:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def touch(self, city, country):
+        """Count request of weather in city"""
+        self.start()
+        with self.lock:
+            self.hits[city, country] = self.hits.get((city, country), 0) + 1
+
+    def schedule(self, city, country):
+        """Put city to the queue of refresh if it is not there yet"""
+        self.start()
+        with self.lock:
+            if (city, country) in self.pending:
+                return
+            try:
+                self.queue.put_nowait((city, country))
+            except Full:
+                logging.info("Refresh queue is full, %s is stale" % city)
+                return
+            self.pending.add((city, country))
+
+    def scan_popular(self):
+        """Refresh the most popular cities of last interval before their
+        weather gets stale"""
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                hits, self.hits = self.hits, {}
+            popular = sorted(hits, key=hits.get, reverse=True)[:self.popular]
+
+            refresh_age = REFRESH_AHEAD * WEATHER_CACHE_TTL
+            for city, country in popular:
+                weather = CACHE.get(cache_key("weather", city, country))
+                if weather is None or weather_age(weather) >= refresh_age:
+                    self.schedule(city, country)
+
+    def refresh(self):
+        """Fetch weather of cities from the queue"""
+        while True:
+            city, country = self.queue.get()
+            try:
+                fetch_weather(city, country)
+            except (UpstreamException, RateLimitedException) as e:
+                logging.info("Cannot refresh weather in %s: %s" % (city, e))
+            except Exception as e:
+                logging.exception("Cannot refresh weather: %s" % e)
+            finally:
+                with self.lock:
+                    self.pending.discard((city, country))
+
+
+REFRESHER = None
+
+
+# ------------------------ Rate limiting ------------------------- #
 
-logging.basicConfig(filename=LOG_FILE,
-                    format='[%(asctime)s] %(levelname)s %(message)s',
-                    level=logging.INFO, datefmt='%Y.%m.%d %H:%M:%S')
+class RateLimiter(object):
+    """
+    Token buckets shared by all uwsgi workers in a file mapped to memory.
+    The first slot is the bucket of lookups of the whole service in
+    upstreams, clients are hashed to other slots. Every slot is locked with
+    fcntl while it is changed, a client which gets the slot of another
+    client starts with full bucket.
+    """
+
+    SLOT = struct.Struct("=Qdd")
+
+    def __init__(self, path, slots=RATE_LIMIT_SLOTS,
+                 client_rate=CLIENT_RATE, client_burst=CLIENT_BURST,
+                 global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST):
+        self.slots = slots
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.lock = threading.Lock()
+
+        size = self.SLOT.size * (slots + 1)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.memory = mmap.mmap(self.fd, size)
+
+    def refill(self, slot, key, rate, burst, now):
+        """
+        :return: tokens in bucket of the slot at the moment now
+        """
+        stored_key, tokens, updated = self.SLOT.unpack_from(
+            self.memory, slot * self.SLOT.size)
+        if stored_key != key:
+            return burst
+        return min(burst, tokens + max(now - updated, 0) * rate)
+
+    def take(self, slot, key, rate, burst, cost):
+        """
+        :return: True if bucket of the slot has enough tokens, they are
+        taken then
+        """
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, self.SLOT.size,
+                        slot * self.SLOT.size)
+            try:
+                now = time.time()
+                left = self.refill(slot, key, rate, burst, now)
+                # Requests bigger than bucket are never allowed
+                allowed = left >= cost
+                if allowed:
+                    left -= cost
+                self.SLOT.pack_into(self.memory, slot * self.SLOT.size,
+                                    key, left, now)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, self.SLOT.size,
+                            slot * self.SLOT.size)
+        return allowed
+
+    def acquire(self, client, cost=1):
+        """
+        :param client: address of client
+        :param cost: number of tokens needed for the request
+        :return: True if request of client is allowed
+        """
+        if self.client_rate <= 0:
+            return True
+        key = struct.unpack_from(
+            "=Q", hashlib.md5(client.encode("utf-8")).digest())[0] or 1
+        return self.take(1 + key % self.slots, key, self.client_rate,
+                         self.client_burst, cost)
+
+    def acquire_upstream(self, cost=1):
+        """
+        :param cost: number of lookups in upstreams
+        :return: True if lookups are allowed by bucket of the service
+        """
+        if self.global_rate <= 0:
+            return True
+        return self.take(0, 0, self.global_rate, self.global_burst, cost)
+
+
+RATE_LIMITER = None
+
+
+def rate_limited(client, cost=1):
+    """
+    :param client: address of client
+    :param cost: number of ips in request
+    :return: True if request should be answered with 429
+    """
+    if RATE_LIMITER is None or RATE_LIMITER.acquire(client, cost):
+        return False
+    logging.info("Rate limit exceeded by %s" % client)
+    return True
+
+
+def upstream_limited(upstream):
+    """
+    :param upstream: name of upstream
+    :return: True if lookups of the service in upstreams exceed the limit,
+    then client gets 429
+    """
+    if RATE_LIMITER is None or RATE_LIMITER.acquire_upstream():
+        return False
+    logging.info("Rate limit of lookups in %s exceeded" % upstream)
+    return True
+
+
+# ------------------------- Application -------------------------- #
+
+CONFIGURED = False
+CONFIGURE_LOCK = threading.Lock()
+
+
+def read_config(config_file):
+    """
+    :param config_file: path to json file with settings
+    :return: dictionary with settings, empty if there is no file
+    """
+    try:
+        with open(config_file) as json_file:
+            return json.load(json_file)
+    except IOError:
+        return {}
+
+
+def create_app(config_file=CONFIG_FILE):
+    """
+    :param config_file: path to json file with settings
+    :return: wsgi application configured with settings from the file
+
+    Import of the module only defines functions and default settings,
+    everything which reads files, environment or opens connections is
+    done here or later on demand. Settings missing in the file get their
+    default values, not ones of previous call.
+    """
+    global TOKEN, CONFIG, CACHE, GEO_DB, BREAKERS, REFRESHER, RATE_LIMITER
+    global CONFIGURED
+
+    TOKEN = os.environ.get("OPEN_WEATHER_TOKEN")
+    if not TOKEN:
+        sys.exit("Provide OPEN_WEATHER_TOKEN for correct work of application")
+
+    CONFIG = read_config(config_file)
+    settings = globals()
+    for name in CONFIG_KEYS:
+        settings[name] = CONFIG.get(name, DEFAULTS[name])
+
+    logging.basicConfig(filename=LOG_FILE,
+                        format='[%(asctime)s] %(levelname)s %(message)s',
+                        level=logging.INFO, datefmt='%Y.%m.%d %H:%M:%S')
+
+    CACHE = CACHE_BACKENDS[CACHE_BACKEND]()
+    GEO_DB = GeoDatabase(GEO_DB_FILE, GEO_DB_CHECK_INTERVAL, GEO_DB_FORMAT) \
+        if GEO_DB_FILE else None
+    BREAKERS = dict((upstream, CircuitBreaker(upstream, BREAKER_THRESHOLD,
+                                              BREAKER_RESET_TIMEOUT))
+                    for upstream in (IPINFO, OPEN_WEATHER))
+    REFRESHER = WeatherRefresher(REFRESH_WORKERS, REFRESH_QUEUE_SIZE,
+                                 REFRESH_INTERVAL, POPULAR_CITIES) \
+        if REFRESH_WORKERS > 0 else None
+    RATE_LIMITER = RateLimiter(RATE_LIMIT_FILE, RATE_LIMIT_SLOTS,
+                               CLIENT_RATE, CLIENT_BURST,
+                               GLOBAL_RATE, GLOBAL_BURST) \
+        if CLIENT_RATE > 0 or GLOBAL_RATE > 0 else None
+
+    CONFIGURED = True
+    return application
 
 
 # -------------------------- Weather api ------------------------- #
@@ -63,17 +733,36 @@ def application(env, start_response):
     :param env: default parameter of wsgi, environment of request
     :param start_response: default wsgi function to make response
     :return: bytes array encoded in utf-8 with response data
+
+    Application is created with default configuration file by the first
+    request if create_app was not called before, under uwsgi it is created
+    when the module is loaded
     """
-    ip_address = env["REQUEST_URI"].replace("/ip2w/", "")
+    if not CONFIGURED:
+        with CONFIGURE_LOCK:
+            if not CONFIGURED:
+                create_app()
+
     logging.info(env["REQUEST_METHOD"] + " " + env["REQUEST_URI"])
+    if env["REQUEST_METHOD"] == "POST":
+        return batch_application(env, start_response)
+
+    ip_address = env["REQUEST_URI"].replace("/ip2w/", "")
 
     if not (check_correct_url(ip_address)):
         return response_with_error(BAD_REQUEST,
                                    "Wrong format of ip {}".format(ip_address),
                                    start_response)
+    if rate_limited(env.get("REMOTE_ADDR", "")):
+        return response_with_error(TOO_MANY_REQUESTS, "Too many requests",
+                                   start_response)
     try:
-        city, country = get_geo(ip_address)
-    except requests.exceptions.ConnectionError as e:
+        city, country = cached_geo(ip_address)
+    except RateLimitedException as e:
+        logging.info(e)
+        return response_with_error(TOO_MANY_REQUESTS, "Too many requests",
+                                   start_response)
+    except UpstreamException as e:
         logging.exception(e)
         return response_with_error(BAD_GATEWAY, "Cannot connect to IpInfo",
                                    start_response)
@@ -85,14 +774,18 @@ def application(env, start_response):
 
     try:
         temperature, conditions = \
-            get_weather(city, country)
+            cached_weather(city, country)
     except NoWeatherException as e:
         logging.exception(e)
         return response_with_error(BAD_REQUEST,
                                    "No weather for ip {}".format(ip_address),
                                    start_response)
 
-    except requests.exceptions.ConnectionError as e:
+    except RateLimitedException as e:
+        logging.info(e)
+        return response_with_error(TOO_MANY_REQUESTS, "Too many requests",
+                                   start_response)
+    except UpstreamException as e:
         logging.exception(e)
         return response_with_error(BAD_GATEWAY, "Cannot connect to OpenWeatherMap",
                                    start_response)
@@ -103,6 +796,103 @@ def application(env, start_response):
                            conditions=conditions)
 
 
+def batch_application(env, start_response):
+    """
+    :param env: default parameter of wsgi, environment of request
+    :param start_response: default wsgi function to make response
+    :return: bytes array encoded in utf-8 with results for every ip
+    from json list in body of request
+    """
+    try:
+        length = int(env.get("CONTENT_LENGTH") or 0)
+        ip_addresses = json.loads(env["wsgi.input"].read(length)
+                                  .decode("utf-8"))
+    except ValueError:
+        ip_addresses = None
+
+    if not (isinstance(ip_addresses, list) and
+            all(isinstance(ip, type(u"")) for ip in ip_addresses)):
+        return response_with_error(BAD_REQUEST, "Expected json list of ips",
+                                   start_response)
+    if len(ip_addresses) > MAX_BATCH_SIZE:
+        return response_with_error(BAD_REQUEST,
+                                   "Too many ips, max {}".format(
+                                       MAX_BATCH_SIZE),
+                                   start_response)
+    valid_ips = set(ip for ip in ip_addresses if check_correct_url(ip))
+    if 0 < CLIENT_RATE and CLIENT_BURST < len(valid_ips):
+        # Bucket of client never has tokens for such batch
+        return response_with_error(BAD_REQUEST,
+                                   "Too many ips, max {}".format(
+                                       CLIENT_BURST),
+                                   start_response)
+    if rate_limited(env.get("REMOTE_ADDR", ""), len(valid_ips)):
+        return response_with_error(TOO_MANY_REQUESTS, "Too many requests",
+                                   start_response)
+
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return create_response(results=resolve_batch(ip_addresses))
+
+
+def resolve_batch(ip_addresses):
+    """
+    :param ip_addresses: list of ip addresses
+    :return: list with city, temperature and conditions or error for
+    every ip in the same order
+
+    Every distinct ip is looked up once and weather is fetched once for
+    every distinct city, so upstreams get at most one request per city
+    instead of two per ip
+    """
+    geos = {}
+    for ip_address in set(ip_addresses):
+        if not check_correct_url(ip_address):
+            geos[ip_address] = "Wrong format of ip {}".format(ip_address)
+            continue
+        try:
+            geo = cached_geo(ip_address)
+        except RateLimitedException as e:
+            logging.info(e)
+            geos[ip_address] = "Too many requests"
+            continue
+        except UpstreamException as e:
+            logging.exception(e)
+            geos[ip_address] = "Cannot connect to IpInfo"
+            continue
+        geos[ip_address] = geo if all(geo) else \
+            "No city for ip {}".format(ip_address)
+
+    weathers = {}
+    for city, country in set(geo for geo in geos.values()
+                             if isinstance(geo, tuple)):
+        try:
+            weathers[city, country] = cached_weather(city, country)
+        except NoWeatherException as e:
+            logging.exception(e)
+            weathers[city, country] = "No weather for ip {}"
+        except RateLimitedException as e:
+            logging.info(e)
+            weathers[city, country] = "Too many requests"
+        except UpstreamException as e:
+            logging.exception(e)
+            weathers[city, country] = "Cannot connect to OpenWeatherMap"
+
+    results = []
+    for ip_address in ip_addresses:
+        geo = geos[ip_address]
+        if not isinstance(geo, tuple):
+            results.append({"ip": ip_address, "error": geo})
+            continue
+        weather = weathers[geo]
+        if isinstance(weather, tuple):
+            results.append({"ip": ip_address, "city": geo[0],
+                            "temp": weather[0], "conditions": weather[1]})
+        else:
+            results.append({"ip": ip_address,
+                            "error": weather.format(ip_address)})
+    return results
+
+
 def check_correct_url(ip_address_):
     """
     :param ip_address_:
@@ -122,7 +912,7 @@ def get_geo(ip_address):
     ip in url belongs to
     """
     url = IPINFO_URL.format(ip_address=ip_address)
-    geo_info = requests.get(url).json()
+    geo_info = fetch_json(IPINFO, url)
     return geo_info.get("city"), geo_info.get("country")
 
 
@@ -134,12 +924,26 @@ def get_weather(city, country):
     conditions in city which passed in url
     """
 
-    url = OPEN_WEATHER_URL.format(city=quote(city),
-                                  country=country,
-                                  token=TOKEN)
+    weather_info = fetch_json(OPEN_WEATHER, weather_url(city, country))
+    return parse_weather(weather_info)
 
-    weather_info = requests.get(url).json()
 
+def weather_url(city, country):
+    """
+    :return: url of openweathermap.org with weather in city
+    """
+    if not isinstance(city, str):
+        city = city.encode("utf-8")
+    return OPEN_WEATHER_URL.format(city=quote(city),
+                                   country=country,
+                                   token=TOKEN)
+
+
+def parse_weather(weather_info):
+    """
+    :param weather_info: decoded json from openweathermap.org
+    :return: temperature and weather conditions
+    """
     try:
         temperature = weather_info.get("main").get("temp")
         temperature = "{temp:+.2f}".format(temp=temperature)
@@ -151,6 +955,93 @@ def get_weather(city, country):
     return temperature, conditions
 
 
+def cached_geo(ip_address):
+    """
+    :param ip_address:
+    :return: city and country of ip address from local database, cache
+    or from get_geo, unknown ip addresses are cached too
+    """
+    if GEO_DB is not None:
+        geo = GEO_DB.lookup(ip_address)
+        if geo is not None:
+            return geo
+
+    key = cache_key("geo", ip_address)
+    geo = CACHE.get(key)
+    if geo is None:
+        geo = get_geo(ip_address)
+        CACHE.set(key, list(geo),
+                  GEO_CACHE_TTL if all(geo) else NEGATIVE_CACHE_TTL)
+    return tuple(geo)
+
+
+def cached_weather(city, country):
+    """
+    :param city: city for which we want weather to know
+    :param country: country needed to uniquely identify city
+    :return: temperature and conditions from cache or from get_weather,
+    cities without weather are cached too and raise NoWeatherException
+
+    Stale weather is returned at once and refreshed in background,
+    without background refresh it is fetched again like a missing one
+    """
+    key = cache_key("weather", city, country)
+    if REFRESHER is not None:
+        REFRESHER.touch(city, country)
+
+    weather = CACHE.get(key)
+    if weather is not None and weather_age(weather) >= WEATHER_CACHE_TTL:
+        if REFRESHER is None:
+            weather = None
+        else:
+            REFRESHER.schedule(city, country)
+
+    if weather is None:
+        weather = fetch_weather(city, country)
+
+    if weather[0] is None:
+        raise NoWeatherException
+    return tuple(weather[:2])
+
+
+def fetch_weather(city, country):
+    """
+    :return: cache entry with weather in city from get_weather
+    """
+    try:
+        weather = get_weather(city, country)
+    except NoWeatherException:
+        weather = None
+    return store_weather(city, country, weather)
+
+
+def store_weather(city, country, weather):
+    """
+    :param weather: temperature and conditions or None if city has no weather
+    :return: cache entry with temperature, conditions and time of fetch,
+    cities without weather are cached too
+    """
+    key = cache_key("weather", city, country)
+    if weather is None:
+        entry = [None, None]
+        CACHE.set(key, entry, NEGATIVE_CACHE_TTL)
+    else:
+        entry = list(weather) + [time.time()]
+        CACHE.set(key, entry, WEATHER_CACHE_TTL + WEATHER_STALE_TTL)
+    return entry
+
+
+def weather_age(weather):
+    """
+    :param weather: cache entry of weather
+    :return: seconds since weather was fetched, cities without weather
+    expire by themselves and are never stale
+    """
+    if len(weather) < 3:
+        return 0
+    return time.time() - weather[2]
+
+
 def create_response(**kwargs):
     """
     :param kwargs: kwargs dictionary depends on status code
@@ -172,3 +1063,10 @@ def response_with_error(status_code, error, start_response):
                                                      code_msg=ERRORS[status_code]),
                    [('Content-Type', 'application/json')])
     return create_response(error=error)
+
+
+# Under uwsgi application is created when workers load the module, so
+# missing token or wrong settings stop the start instead of the first request.
+# uwsgi registers its embedded module before it loads the application
+if "uwsgi" in sys.modules:
+    create_app()
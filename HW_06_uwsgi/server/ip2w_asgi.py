@@ -0,0 +1,304 @@
+import asyncio
+import logging
+import random
+
+import httpx
+
+import ip2w
+from ip2w import (BAD_GATEWAY, BAD_REQUEST, IPINFO, METHOD_NOT_ALLOWED,
+                  OPEN_WEATHER, TOO_MANY_REQUESTS, NoWeatherException,
+                  RateLimitedException, UpstreamException,
+                  cache_key, check_correct_url, create_response,
+                  parse_weather, rate_limited, response_with_error,
+                  store_weather, upstream_limited, weather_age,
+                  weather_url)
+
+# -------------------------- Constants --------------------------- #
+
+# One event loop serves many lookups, so it needs more connections
+# than a uwsgi worker
+ASYNC_POOL_SIZE = 100
+
+
+# ------------------------ Upstream calls ------------------------ #
+
+async def blocking(function, *args):
+    """
+    :param function: function which may wait for memcached, file locks of
+    rate limits or reload of geo database
+    :return: result of the function called in thread pool, so the event
+    loop serves other requests meanwhile
+    """
+    return await asyncio.get_event_loop().run_in_executor(None, function,
+                                                          *args)
+
+
+class AsyncUpstreams:
+    """
+    Async http client of the process shared by all requests. Concurrent
+    lookups of the same key wait for one upstream request.
+    """
+
+    def __init__(self):
+        self.client = None
+        self.in_flight = {}
+        self.refreshing = 0
+
+    def get_client(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(ip2w.READ_TIMEOUT,
+                                      connect=ip2w.CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=ASYNC_POOL_SIZE,
+                                    max_keepalive_connections=ASYNC_POOL_SIZE))
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def fetch_json(self, upstream, url):
+        """
+        :param upstream: name of upstream for its circuit breaker
+        :param url: url to get
+        :return: decoded json of response
+
+        Async version of ip2w.fetch_json with the same retries, circuit
+        breakers and rate limit
+        """
+        if await blocking(upstream_limited, upstream):
+            raise RateLimitedException("Rate limit of %s is exceeded" %
+                                       upstream)
+        breaker = ip2w.BREAKERS[upstream]
+        if not breaker.allow():
+            raise UpstreamException("Circuit of %s is open" % upstream)
+
+        for attempt in range(ip2w.RETRIES + 1):
+            try:
+                response = await self.get_client().get(url)
+                if response.status_code >= 500 or response.status_code == 429:
+                    raise httpx.HTTPError(
+                        "%s returned %s" % (upstream, response.status_code))
+                result = response.json()
+            except (httpx.HTTPError, ValueError) as e:
+                logging.info("Request to %s failed: %s" % (upstream, e))
+                if attempt == ip2w.RETRIES:
+                    breaker.failure()
+                    raise UpstreamException("%s failed: %s" % (upstream, e))
+                await asyncio.sleep(random.uniform(
+                    0, min(ip2w.RETRY_BACKOFF * 2 ** attempt,
+                           ip2w.RETRY_BACKOFF_MAX)))
+            else:
+                breaker.success()
+                return result
+
+    def start_flight(self, key, coroutine_function, *args):
+        """
+        :param key: key of the lookup
+        :param coroutine_function: function which makes the lookup
+        :return: future of the lookup shared by concurrent callers
+        """
+        future = self.in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(coroutine_function(*args))
+            self.in_flight[key] = future
+            future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        return future
+
+    async def single_flight(self, key, coroutine_function, *args):
+        """
+        :return: result of the lookup shared by concurrent callers
+        """
+        return await asyncio.shield(
+            self.start_flight(key, coroutine_function, *args))
+
+    def refresh_weather(self, key, city, country):
+        """Refresh stale weather in background task, number of the tasks is
+        bounded and stale weather is served while they run"""
+        if key in self.in_flight or \
+                self.refreshing >= ip2w.REFRESH_QUEUE_SIZE:
+            return
+        self.refreshing += 1
+
+        def done(future):
+            self.refreshing -= 1
+            if not future.cancelled() and future.exception() is not None:
+                logging.info("Cannot refresh weather in %s: %s" %
+                             (city, future.exception()))
+
+        self.start_flight(key, self.fetch_weather,
+                          city, country).add_done_callback(done)
+
+    async def get_geo(self, ip_address):
+        geo_info = await self.fetch_json(
+            IPINFO, ip2w.IPINFO_URL.format(ip_address=ip_address))
+        return geo_info.get("city"), geo_info.get("country")
+
+    async def get_weather(self, city, country):
+        weather_info = await self.fetch_json(OPEN_WEATHER,
+                                             weather_url(city, country))
+        return parse_weather(weather_info)
+
+    async def fetch_weather(self, city, country):
+        try:
+            weather = await self.get_weather(city, country)
+        except NoWeatherException:
+            weather = None
+        return await blocking(store_weather, city, country, weather)
+
+    async def cached_geo(self, ip_address):
+        """
+        :param ip_address:
+        :return: city and country of ip address, the same as ip2w.cached_geo
+        """
+        if ip2w.GEO_DB is not None:
+            geo = await blocking(ip2w.GEO_DB.lookup, ip_address)
+            if geo is not None:
+                return geo
+
+        key = cache_key("geo", ip_address)
+        geo = await blocking(ip2w.CACHE.get, key)
+        if geo is None:
+            geo = await self.single_flight(key, self.get_geo, ip_address)
+            await blocking(ip2w.CACHE.set, key, list(geo),
+                           ip2w.GEO_CACHE_TTL if all(geo)
+                           else ip2w.NEGATIVE_CACHE_TTL)
+        return tuple(geo)
+
+    async def cached_weather(self, city, country):
+        """
+        :param city: city for which we want weather to know
+        :param country: country needed to uniquely identify city
+        :return: temperature and conditions, the same as ip2w.cached_weather
+        """
+        key = cache_key("weather", city, country)
+        weather = await blocking(ip2w.CACHE.get, key)
+        if weather is not None and \
+                weather_age(weather) >= ip2w.WEATHER_CACHE_TTL:
+            self.refresh_weather(key, city, country)
+
+        if weather is None:
+            weather = await self.single_flight(key, self.fetch_weather,
+                                               city, country)
+
+        if weather[0] is None:
+            raise NoWeatherException
+        return tuple(weather[:2])
+
+
+UPSTREAMS = AsyncUpstreams()
+
+
+# -------------------------- Weather api ------------------------- #
+
+async def handle(path, client, start_response):
+    """
+    :param path: path of request
+    :param client: address of client
+    :param start_response: function with wsgi signature to save status
+    and headers of response
+    :return: list with data encoded in utf-8 to pass to response
+    """
+    ip_address = path.replace("/ip2w/", "")
+
+    if not (check_correct_url(ip_address)):
+        return response_with_error(BAD_REQUEST,
+                                   "Wrong format of ip {}".format(ip_address),
+                                   start_response)
+    if await blocking(rate_limited, client):
+        return response_with_error(TOO_MANY_REQUESTS, "Too many requests",
+                                   start_response)
+    try:
+        city, country = await UPSTREAMS.cached_geo(ip_address)
+    except RateLimitedException as e:
+        logging.info(e)
+        return response_with_error(TOO_MANY_REQUESTS, "Too many requests",
+                                   start_response)
+    except UpstreamException as e:
+        logging.exception(e)
+        return response_with_error(BAD_GATEWAY, "Cannot connect to IpInfo",
+                                   start_response)
+
+    if not (city and country):
+        return response_with_error(BAD_REQUEST,
+                                   "No city for ip {}".format(ip_address),
+                                   start_response)
+
+    try:
+        temperature, conditions = \
+            await UPSTREAMS.cached_weather(city, country)
+    except NoWeatherException as e:
+        logging.exception(e)
+        return response_with_error(BAD_REQUEST,
+                                   "No weather for ip {}".format(ip_address),
+                                   start_response)
+
+    except RateLimitedException as e:
+        logging.info(e)
+        return response_with_error(TOO_MANY_REQUESTS, "Too many requests",
+                                   start_response)
+    except UpstreamException as e:
+        logging.exception(e)
+        return response_with_error(BAD_GATEWAY, "Cannot connect to OpenWeatherMap",
+                                   start_response)
+
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return create_response(city=city,
+                           temp=temperature,
+                           conditions=conditions)
+
+
+async def lifespan(receive, send):
+    """Configure application on startup and close connections to upstreams
+    on shutdown of the server"""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            ip2w.create_app()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await UPSTREAMS.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    """
+    :param scope: default parameter of asgi, description of request
+    :param receive: default asgi function to get events from client
+    :param send: default asgi function to send response
+
+    Asgi version of ip2w.application, one process serves many lookups
+    while it waits for upstreams
+    """
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if not ip2w.CONFIGURED:
+        ip2w.create_app()
+
+    logging.info(scope["method"] + " " + scope["path"])
+
+    response = {}
+
+    def start_response(status, headers):
+        response["status"], response["headers"] = status, headers
+
+    if scope["method"] == "GET":
+        client = scope["client"][0] if scope.get("client") else ""
+        body = await handle(scope["path"], client, start_response)
+    else:
+        # Batches of ip2w.batch_application are served by the wsgi variant
+        body = response_with_error(METHOD_NOT_ALLOWED,
+                                   "Method {} is not allowed".format(
+                                       scope["method"]),
+                                   start_response)
+        response["headers"].append(("Allow", "GET"))
+
+    await send({
+        "type": "http.response.start",
+        "status": int(response["status"].split()[0]),
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in response["headers"]],
+    })
+    await send({"type": "http.response.body", "body": b"".join(body)})
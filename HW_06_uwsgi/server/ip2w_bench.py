@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from optparse import OptionParser
+
+import ip2w
+from upstream_sim import UpstreamSimulator
+
+# -------------------------- Constants --------------------------- #
+
+# Settings of ip2w for every mode, upstream urls are added by benchmark
+MODES = {
+    "cache": {"CACHE_BACKEND": "local"},
+    "no_cache": {"CACHE_BACKEND": "none", "REFRESH_WORKERS": 0},
+}
+
+DEFAULT_MODES = "no_cache,cache"
+DEFAULT_CONCURRENCY = "1,10,50"
+
+PERCENTILES = (50, 90, 99)
+
+
+# ------------------------ Load generator ------------------------ #
+
+def percentile(sorted_values, percent):
+    """
+    :param sorted_values: sorted list of numbers
+    :param percent: percentile from 0 to 100
+    :return: value of percentile by nearest-rank method
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(percent / 100 * len(sorted_values))), 1)
+    return sorted_values[rank - 1]
+
+
+def make_ips(count, seed):
+    """
+    :return: list of count distinct public ip addresses
+    """
+    generator = random.Random(seed)
+    ips = set()
+    while len(ips) < count:
+        ips.add("%d.%d.%d.%d" % (generator.randint(11, 99),
+                                 generator.randint(0, 255),
+                                 generator.randint(0, 255),
+                                 generator.randint(1, 254)))
+    return sorted(ips)
+
+
+def create_app(simulator, mode, log_file):
+    """
+    :param simulator: running UpstreamSimulator
+    :param mode: name of mode from MODES
+    :param log_file: file for logs of application
+    :return: wsgi application configured for the mode
+    """
+    config = dict(MODES[mode], IPINFO_URL=simulator.ipinfo_url,
+                  OPEN_WEATHER_URL=simulator.weather_url, LOG_FILE=log_file,
+                  CLIENT_RATE=0, GLOBAL_RATE=0)
+    config_file, path = tempfile.mkstemp(suffix=".json")
+    os.write(config_file, json.dumps(config).encode("utf-8"))
+    os.close(config_file)
+    try:
+        return ip2w.create_app(path)
+    finally:
+        os.remove(path)
+
+
+def run_connection(application, requests_, stats, lock):
+    """
+    :param application: wsgi application
+    :param requests_: list of ips, shared by threads
+    :param stats: dictionary with latencies and statuses of responses
+    :param lock: threading.Lock for requests_ and stats
+    """
+    latencies, statuses = [], {}
+
+    def start_response(status, headers):
+        statuses[status] = statuses.get(status, 0) + 1
+
+    while True:
+        with lock:
+            if not requests_:
+                break
+            ip_address = requests_.pop()
+
+        env = {"REQUEST_METHOD": "GET", "REQUEST_URI": "/ip2w/" + ip_address,
+               "REMOTE_ADDR": "127.0.0.1"}
+        start = time.time()
+        b"".join(application(env, start_response))
+        latencies.append(time.time() - start)
+
+    with lock:
+        stats["latencies"].extend(latencies)
+        for status, count in statuses.items():
+            stats["statuses"][status] = stats["statuses"].get(status, 0) + count
+
+
+def run_workload(application, simulator, ips, options, mode, concurrency):
+    """
+    :param application: wsgi application
+    :param simulator: running UpstreamSimulator
+    :param ips: list of distinct ips
+    :param options: options from OptionsParser
+    :param mode: name of mode from MODES
+    :param concurrency: number of simultaneous requests
+    :return: dictionary with results of the workload
+    """
+    generator = random.Random(options.seed)
+    requests_ = [generator.choice(ips) for _ in range(options.requests)]
+    stats = {"latencies": [], "statuses": {}}
+    lock = threading.Lock()
+    upstream_before = dict(simulator.counts)
+
+    threads = [threading.Thread(target=run_connection,
+                                args=(application, requests_, stats, lock))
+               for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - start
+
+    latencies = sorted(stats["latencies"])
+    latency_ms = dict(("p{}".format(percent),
+                       round(percentile(latencies, percent) * 1000, 3))
+                      for percent in PERCENTILES)
+    latency_ms["mean"] = round(sum(latencies) / len(latencies) * 1000, 3) \
+        if latencies else 0.0
+    latency_ms["max"] = round(latencies[-1] * 1000, 3) if latencies else 0.0
+
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "requests": options.requests,
+        "duration": round(duration, 3),
+        "requests_per_sec": round(len(latencies) / duration, 2),
+        "latency_ms": latency_ms,
+        "statuses": stats["statuses"],
+        "upstream_requests": dict(
+            (name, count - upstream_before[name])
+            for name, count in simulator.counts.items()),
+    }
+
+
+# ---------------------------- Report ---------------------------- #
+
+def print_report(results):
+    """
+    :param results: list with results of workloads
+    """
+    line = "{:<10} {:>5} {:>10} {:>9} {:>9} {:>9} {:>9} {:>9}"
+    print(line.format("mode", "conc", "req/sec", "p50 ms", "p90 ms",
+                      "p99 ms", "upstream", "non 200"), file=sys.stderr)
+    for result in results:
+        not_ok = sum(count for status, count in result["statuses"].items()
+                     if not status.startswith("200"))
+        print(line.format(result["mode"], result["concurrency"],
+                          result["requests_per_sec"],
+                          result["latency_ms"]["p50"],
+                          result["latency_ms"]["p90"],
+                          result["latency_ms"]["p99"],
+                          sum(result["upstream_requests"].values()), not_ok),
+              file=sys.stderr)
+
+
+def main(options):
+    """
+    :param options: options from OptionsParser
+    :return: dictionary with description of the run and results of workloads
+    """
+    modes = options.modes.split(",")
+    for mode in modes:
+        if mode not in MODES:
+            raise ValueError("Unknown mode {}".format(mode))
+    concurrency_levels = [int(level) for level in
+                          options.concurrency.split(",")]
+
+    simulator = UpstreamSimulator(port=options.port,
+                                  latency=options.latency / 1000,
+                                  jitter=options.jitter / 1000,
+                                  error_rate=options.error_rate,
+                                  cities=options.cities).start()
+    ips = make_ips(options.ips, options.seed)
+
+    results = []
+    try:
+        for mode in modes:
+            for concurrency in concurrency_levels:
+                print("Running {} with concurrency {}".format(
+                    mode, concurrency), file=sys.stderr)
+                # Every workload starts with empty caches
+                application = create_app(simulator, mode, options.log)
+                results.append(run_workload(application, simulator, ips,
+                                            options, mode, concurrency))
+    finally:
+        # Handlers of simulator exit when kept alive connections are closed
+        if ip2w.SESSION["session"] is not None:
+            ip2w.SESSION["session"].close()
+        simulator.stop()
+
+    return {
+        "python": sys.version.split()[0],
+        "upstream_latency_ms": options.latency,
+        "upstream_error_rate": options.error_rate,
+        "ips": options.ips,
+        "cities": options.cities,
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+
+
+# ---------------------------- Main ----------------------------- #
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-n", "--requests", action="store", type=int, default=2000)
+    op.add_option("-c", "--concurrency", action="store",
+                  default=DEFAULT_CONCURRENCY)
+    op.add_option("--modes", action="store", default=DEFAULT_MODES)
+    op.add_option("--ips", action="store", type=int, default=500,
+                  help="number of distinct ips in requests")
+    op.add_option("--cities", action="store", type=int, default=100)
+    op.add_option("--latency", action="store", type=float, default=50,
+                  help="mean latency of upstreams in ms")
+    op.add_option("--jitter", action="store", type=float, default=10)
+    op.add_option("--error_rate", action="store", type=float, default=0.0)
+    op.add_option("-p", "--port", action="store", type=int, default=8090,
+                  help="port of upstream simulator")
+    op.add_option("--seed", action="store", type=int, default=1)
+    op.add_option("--log", action="store", default=os.devnull,
+                  help="file for logs of application")
+    op.add_option("-o", "--output", action="store", default=None)
+    (opts, args) = op.parse_args()
+
+    os.environ.setdefault("OPEN_WEATHER_TOKEN", "ip2w_bench")
+
+    report = main(opts)
+    print_report(report["results"])
+
+    if opts.output:
+        with open(opts.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
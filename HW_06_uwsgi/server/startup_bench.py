@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+from optparse import OptionParser
+
+# -------------------------- Constants --------------------------- #
+
+# Steps of worker start, every step is measured in a fresh interpreter
+# after the steps before it: name -> code
+STEPS = (
+    ("import", "import ip2w"),
+    ("create_app", "ip2w.create_app({config!r})"),
+    ("import_requests", "ip2w.get_session()"),
+)
+
+CHILD = """
+import sys, time
+sys.path.insert(0, {path!r})
+{before}
+start = time.time()
+{code}
+sys.stdout.write(repr(time.time() - start))
+"""
+
+
+# ------------------------- Measurements ------------------------- #
+
+def run_step(index, options):
+    """
+    :param index: index of step in STEPS
+    :param options: options from OptionsParser
+    :return: seconds of the step and of the whole interpreter run
+    """
+    codes = [code.format(config=options.config) for _, code in STEPS]
+    source = CHILD.format(path=os.path.dirname(os.path.abspath(__file__)),
+                          before="\n".join(codes[:index]),
+                          code=codes[index])
+
+    env = dict(os.environ)
+    env.setdefault("OPEN_WEATHER_TOKEN", "startup_bench")
+    start = time.time()
+    output = subprocess.check_output([options.python, "-c", source], env=env)
+    return float(output), time.time() - start
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def main(options):
+    """
+    :param options: options from OptionsParser
+    :return: dictionary with milliseconds of every step
+    """
+    results = []
+    for index, (name, _) in enumerate(STEPS):
+        runs = [run_step(index, options) for _ in range(options.runs)]
+        step = [run[0] * 1000 for run in runs]
+        process = [run[1] * 1000 for run in runs]
+        results.append({
+            "step": name,
+            "median_ms": round(median(step), 3),
+            "min_ms": round(min(step), 3),
+            "max_ms": round(max(step), 3),
+            "process_median_ms": round(median(process), 3),
+        })
+
+    return {
+        "python": options.python,
+        "runs": options.runs,
+        "results": results,
+    }
+
+
+# ---------------------------- Main ----------------------------- #
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-n", "--runs", action="store", type=int, default=20)
+    op.add_option("--python", action="store", default=sys.executable)
+    op.add_option("--config", action="store",
+                  default="/usr/local/etc/config_ip2w.json")
+    op.add_option("-o", "--output", action="store", default=None)
+    (opts, args) = op.parse_args()
+
+    report = main(opts)
+
+    line = "{:<16} {:>10} {:>10} {:>10} {:>12}"
+    print(line.format("step", "median ms", "min ms", "max ms", "process ms"),
+          file=sys.stderr)
+    for result in report["results"]:
+        print(line.format(result["step"], result["median_ms"],
+                          result["min_ms"], result["max_ms"],
+                          result["process_median_ms"]), file=sys.stderr)
+
+    if opts.output:
+        with open(opts.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -1,8 +1,17 @@
+# -*- coding: utf-8 -*-
+import io
+import json
 import logging
+import os
 import requests
+import tempfile
+import time
 import unittest
 
-from ip2w import get_geo, check_correct_url, IPINFO_URL, OK, BAD_REQUEST, BAD_GATEWAY
+import ip2w
+from upstream_sim import UpstreamSimulator
+from ip2w import get_geo, check_correct_url, GeoDatabase, RateLimiter, \
+    WeatherRefresher, IPINFO_URL, OK, BAD_REQUEST, BAD_GATEWAY
 
 logging.disable(logging.ERROR)
 
@@ -48,6 +57,133 @@ class TestAPI(unittest.TestCase):
         """Is ip checked correctly?"""
         self.assertEqual(check_correct_url(ip_address), bool_value)
 
+    @cases([
+        ("8.8.8.8", ("Mountain View", "US")),
+        ("1.0.0.5", ("Brisbane", "AU")),
+        ("10.1.1.1", (None, None)),
+        ("9.9.9.9", None),
+    ])
+    def test_local_geo(self, ip_address, geo):
+        """Is city found in local geo database?"""
+        csv_file, path = tempfile.mkstemp()
+        os.write(csv_file, b'"8.8.8.0","8.8.8.255","US","Mountain View"\n'
+                           b'16777216,16777471,AU,Brisbane\n'
+                           b'10.0.0.0,10.255.255.255,,\n'
+                           b'4294967296,4294967300,XX,Overflow\n')
+        os.close(csv_file)
+        try:
+            self.assertEqual(GeoDatabase(path).lookup(ip_address), geo)
+        finally:
+            os.remove(path)
+
+    @cases([
+        ("8.8.8.8", ("Mountain View", "US")),
+        ("9.9.9.9", None),
+        ("10.1.1.1", (None, None)),
+    ])
+    def test_ip2location_geo(self, ip_address, geo):
+        """Is city found in ip2location csv file?"""
+        csv_file, path = tempfile.mkstemp()
+        os.write(csv_file, b'"134744064","134744319","US",'
+                           b'"United States of America","California",'
+                           b'"Mountain View"\n'
+                           b'"167772160","184549375","-","-","-","-"\n'
+                           b'"281470681743360","281474976710655","-","-","-","-"\n')
+        os.close(csv_file)
+        try:
+            geo_db = GeoDatabase(path, db_format="ip2location")
+            self.assertEqual(geo_db.lookup(ip_address), geo)
+        finally:
+            os.remove(path)
+
+    @cases([
+        ([("1.1.1.1", 1)] * 3, [True, True, False]),
+        ([("1.1.1.1", 1), ("2.2.2.2", 1), ("1.1.1.1", 1)], [True, True, True]),
+        ([("1.1.1.1", 1)] * 3 + [("2.2.2.2", 1)] * 3,
+         [True, True, False, True, True, False]),
+        ([("1.1.1.1", 2), ("1.1.1.1", 1)], [True, False]),
+        ([("1.1.1.1", 10), ("1.1.1.1", 1)], [False, True]),
+    ])
+    def test_rate_limit(self, requests_, allowed):
+        """Are client limits shared by limiters of workers?"""
+        path = tempfile.mktemp()
+        workers = [RateLimiter(path, 16, 0.001, 2, 0.001, 4) for _ in range(2)]
+        try:
+            self.assertEqual([workers[i % 2].acquire(client, cost)
+                              for i, (client, cost) in enumerate(requests_)],
+                             allowed)
+        finally:
+            os.remove(path)
+
+    @cases([
+        ([3, 1, 1], [True, True, False]),
+        ([4, 1], [True, False]),
+        ([10, 1], [False, True]),
+    ])
+    def test_upstream_rate_limit(self, costs, allowed):
+        """Is bucket of upstream lookups shared by workers and not charged
+        by clients?"""
+        path = tempfile.mktemp()
+        workers = [RateLimiter(path, 16, 0.001, 20, 0.001, 4) for _ in range(2)]
+        try:
+            self.assertTrue(all(workers[0].acquire("1.1.1.1") for _ in range(10)))
+            self.assertEqual([workers[i % 2].acquire_upstream(cost)
+                              for i, cost in enumerate(costs)], allowed)
+        finally:
+            os.remove(path)
+
+    @cases([
+        ("1.0.0.23", "200 OK", {"city": "City 39", "temp": "+27.25",
+                                "conditions": u"небольшой дождь"}),
+        ("127.0.0.1", "400 Bad Request", {"error": "No city for ip 127.0.0.1"}),
+        ("1.2.3.a", "400 Bad Request", {"error": "Wrong format of ip 1.2.3.a"}),
+    ])
+    def test_offline_application(self, ip_address, status, content):
+        """Is application response correct with simulated upstreams?"""
+        os.environ.setdefault("OPEN_WEATHER_TOKEN", "tests")
+        simulator = UpstreamSimulator(port=0, latency=0, jitter=0).start()
+        config_file, path = tempfile.mkstemp()
+        os.write(config_file, json.dumps({
+            "IPINFO_URL": simulator.ipinfo_url,
+            "OPEN_WEATHER_URL": simulator.weather_url,
+            "CACHE_BACKEND": "none", "REFRESH_WORKERS": 0,
+            "CLIENT_RATE": 0, "GLOBAL_RATE": 0,
+        }).encode("utf-8"))
+        os.close(config_file)
+        try:
+            application = ip2w.create_app(path)
+            statuses = []
+            response = application({"REQUEST_METHOD": "GET",
+                                    "REQUEST_URI": "/ip2w/" + ip_address},
+                                   lambda status_, headers: statuses.append(status_))
+            self.assertEqual(statuses, [status])
+            self.assertEqual(json.loads(b"".join(response).decode("utf-8")), content)
+        finally:
+            os.remove(path)
+            simulator.stop()
+
+    def test_config_defaults(self):
+        """Are settings missing in configuration file reset to defaults?"""
+        os.environ.setdefault("OPEN_WEATHER_TOKEN", "tests")
+        paths = []
+        for config in ({"CACHE_BACKEND": "none", "REFRESH_WORKERS": 0,
+                        "CLIENT_RATE": 0, "GLOBAL_RATE": 0},
+                       {"CLIENT_RATE": 0, "GLOBAL_RATE": 0}):
+            config_file, path = tempfile.mkstemp()
+            os.write(config_file, json.dumps(config).encode("utf-8"))
+            os.close(config_file)
+            paths.append(path)
+        try:
+            ip2w.create_app(paths[0])
+            self.assertIsNone(ip2w.REFRESHER)
+            ip2w.create_app(paths[1])
+            self.assertEqual(ip2w.CACHE_BACKEND, "local")
+            self.assertEqual(ip2w.REFRESH_WORKERS, ip2w.DEFAULTS["REFRESH_WORKERS"])
+            self.assertIsNotNone(ip2w.REFRESHER)
+        finally:
+            for path in paths:
+                os.remove(path)
+
     @cases([
         "198.100.200.10",
         "8.8.8.8",
@@ -77,5 +213,270 @@ class TestAPI(unittest.TestCase):
                          "No city for ip {}".format(url))
 
 
+class SimulatedTestCase(unittest.TestCase):
+    """Base of tests which run application with simulated upstreams"""
+
+    def setUp(self):
+        os.environ.setdefault("OPEN_WEATHER_TOKEN", "tests")
+        self.simulator = None
+
+    def tearDown(self):
+        # Handlers of simulator exit when kept alive connections are closed
+        if ip2w.SESSION["session"] is not None:
+            ip2w.SESSION["session"].close()
+            ip2w.SESSION["pid"] = None
+        if self.simulator is not None:
+            self.simulator.stop()
+
+    def create_app(self, payloads=None, error_rate=0, latency=0, **config):
+        """Start simulator and configure application with it"""
+        self.simulator = UpstreamSimulator(port=0, latency=latency, jitter=0,
+                                           error_rate=error_rate,
+                                           payloads=payloads).start()
+        settings = {"IPINFO_URL": self.simulator.ipinfo_url,
+                    "OPEN_WEATHER_URL": self.simulator.weather_url,
+                    "CACHE_BACKEND": "local", "REFRESH_WORKERS": 0,
+                    "CLIENT_RATE": 0, "GLOBAL_RATE": 0}
+        settings.update(config)
+        config_file, path = tempfile.mkstemp()
+        os.write(config_file, json.dumps(settings).encode("utf-8"))
+        os.close(config_file)
+        try:
+            return ip2w.create_app(path)
+        finally:
+            os.remove(path)
+
+    @staticmethod
+    def request(application, ip_address):
+        """:return: status and decoded json of response"""
+        statuses = []
+        response = application({"REQUEST_METHOD": "GET",
+                                "REQUEST_URI": "/ip2w/" + ip_address},
+                               lambda status_, headers: statuses.append(status_))
+        return statuses[0], json.loads(b"".join(response).decode("utf-8"))
+
+    def counts(self):
+        """:return: numbers of requests to IpInfo and OpenWeatherMap"""
+        return self.simulator.counts["ipinfo"], self.simulator.counts["weather"]
+
+    def wait_count(self, name, count, timeout=3):
+        """Wait for background requests to simulator"""
+        deadline = time.time() + timeout
+        while self.simulator.counts[name] < count and time.time() < deadline:
+            time.sleep(0.01)
+        return self.simulator.counts[name]
+
+
+class TestCache(SimulatedTestCase):
+    """Caches of geo and weather"""
+
+    def test_cache_ttl(self):
+        """Are geo and weather cached until their ttl?"""
+        application = self.create_app(WEATHER_CACHE_TTL=0.2)
+        first = self.request(application, "1.0.0.23")
+        self.assertEqual(self.request(application, "1.0.0.23"), first)
+        self.assertEqual(self.counts(), (1, 1))
+
+        time.sleep(0.3)
+        self.assertEqual(self.request(application, "1.0.0.23"), first)
+        self.assertEqual(self.counts(), (1, 2))
+
+    def test_negative_cache(self):
+        """Are ips without city and cities without weather cached?"""
+        application = self.create_app(
+            payloads={"ipinfo": {"1.2.3.4": {"city": "Nowhere", "country": "XX"}},
+                      "weather": {"Nowhere,XX": {"cod": "404",
+                                                 "message": "city not found"}}},
+            WEATHER_CACHE_TTL=0.1)
+        for _ in range(2):
+            self.assertEqual(self.request(application, "127.0.0.1"),
+                             ("400 Bad Request",
+                              {"error": "No city for ip 127.0.0.1"}))
+            self.assertEqual(self.request(application, "1.2.3.4"),
+                             ("400 Bad Request",
+                              {"error": "No weather for ip 1.2.3.4"}))
+            time.sleep(0.2)
+        self.assertEqual(self.counts(), (2, 1))
+
+
+class TestUpstreams(SimulatedTestCase):
+    """Retries and circuit breaker of upstreams"""
+
+    def test_retry_and_breaker(self):
+        """Are failed requests retried and is 502 returned when circuit is open?"""
+        application = self.create_app(error_rate=1.0, RETRIES=2,
+                                      RETRY_BACKOFF=0.001, BREAKER_THRESHOLD=1)
+        self.assertEqual(self.request(application, "1.0.0.23"),
+                         ("502 Bad Gateway", {"error": "Cannot connect to IpInfo"}))
+        self.assertEqual(self.simulator.counts["errors"], 3)
+
+        self.assertEqual(self.request(application, "1.0.0.24"),
+                         ("502 Bad Gateway", {"error": "Cannot connect to IpInfo"}))
+        self.assertEqual(self.simulator.counts["errors"], 3)
+
+    def test_upstream_rate_limit(self):
+        """Are lookups over the global limit answered with 429?"""
+        path = tempfile.mktemp()
+        try:
+            application = self.create_app(RATE_LIMIT_FILE=path, GLOBAL_RATE=0.001,
+                                          GLOBAL_BURST=2, BREAKER_THRESHOLD=1)
+            self.assertEqual(self.request(application, "1.0.0.23")[0], "200 OK")
+            self.assertEqual(self.request(application, "1.0.0.24"),
+                             ("429 Too Many Requests",
+                              {"error": "Too many requests"}))
+            self.assertEqual(self.counts(), (1, 1))
+            self.assertTrue(ip2w.BREAKERS[ip2w.IPINFO].allow())
+        finally:
+            os.remove(path)
+
+
+class TestRefresh(SimulatedTestCase):
+    """Background refresh of weather"""
+
+    def test_negative_refresh(self):
+        """Are cities without weather kept out of background refresh?"""
+        application = self.create_app(
+            payloads={"ipinfo": {"1.2.3.4": {"city": "Nowhere", "country": "XX"}},
+                      "weather": {"Nowhere,XX": {"cod": "404",
+                                                 "message": "city not found"}}},
+            REFRESH_WORKERS=1, WEATHER_CACHE_TTL=0.1)
+        for _ in range(2):
+            self.assertEqual(self.request(application, "1.2.3.4"),
+                             ("400 Bad Request",
+                              {"error": "No weather for ip 1.2.3.4"}))
+            time.sleep(0.2)
+        # Cities without weather are never stale and are not refreshed
+        self.assertEqual(ip2w.REFRESHER.pending, set())
+        self.assertTrue(ip2w.REFRESHER.queue.empty())
+
+    def test_stale_weather(self):
+        """Is stale weather served at once and refreshed in background?"""
+        application = self.create_app(REFRESH_WORKERS=1, WEATHER_CACHE_TTL=0.2,
+                                      WEATHER_STALE_TTL=60, REFRESH_INTERVAL=60)
+        first = self.request(application, "1.0.0.23")
+        time.sleep(0.3)
+        self.assertEqual(self.request(application, "1.0.0.23"), first)
+        self.assertEqual(self.wait_count("weather", 2), 2)
+        self.assertEqual(self.simulator.counts["ipinfo"], 1)
+
+    def test_refresh_queue(self):
+        """Are cities scheduled once and dropped when refresh queue is full?"""
+        refresher = WeatherRefresher(workers=0, queue_size=1, interval=60)
+        refresher.schedule("City 1", "C1")
+        refresher.schedule("City 1", "C1")
+        refresher.schedule("City 2", "C2")
+        self.assertEqual(refresher.queue.qsize(), 1)
+        self.assertEqual(refresher.pending, {("City 1", "C1")})
+
+class TestBatch(SimulatedTestCase):
+    """Batches of ips in POST requests"""
+
+    def test_batch_dedup(self):
+        """Is every distinct ip and city looked up once in batch?"""
+        application = self.create_app(CACHE_BACKEND="none")
+        ips = ["1.0.0.23", "1.0.0.123", "1.0.0.23", "1.2.3.a"]
+        body = json.dumps(ips).encode("utf-8")
+        statuses = []
+        response = application({"REQUEST_METHOD": "POST", "REQUEST_URI": "/ip2w/",
+                                "CONTENT_LENGTH": str(len(body)),
+                                "wsgi.input": io.BytesIO(body)},
+                               lambda status_, headers: statuses.append(status_))
+        results = json.loads(b"".join(response).decode("utf-8"))["results"]
+
+        self.assertEqual(statuses, ["200 OK"])
+        self.assertEqual([result["ip"] for result in results], ips)
+        self.assertEqual(results[0], results[2])
+        self.assertEqual(results[1]["city"], "City 39")
+        self.assertEqual(results[3]["error"], "Wrong format of ip 1.2.3.a")
+        self.assertEqual(self.counts(), (2, 1))
+
+    def test_batch_over_burst(self):
+        """Is batch with more ips than client burst rejected?"""
+        path = tempfile.mktemp()
+        try:
+            application = self.create_app(RATE_LIMIT_FILE=path, CLIENT_RATE=0.001,
+                                          CLIENT_BURST=5)
+            body = json.dumps(["1.0.0.%s" % i for i in range(6)]).encode("utf-8")
+            statuses = []
+            application({"REQUEST_METHOD": "POST", "REQUEST_URI": "/ip2w/",
+                         "CONTENT_LENGTH": str(len(body)),
+                         "wsgi.input": io.BytesIO(body)},
+                        lambda status_, headers: statuses.append(status_))
+            self.assertEqual(statuses, ["400 Bad Request"])
+            self.assertEqual(self.counts(), (0, 0))
+        finally:
+            os.remove(path)
+
+
+class TestAsgi(SimulatedTestCase):
+    """Asgi variant of the application"""
+
+    def setUp(self):
+        super(TestAsgi, self).setUp()
+        try:
+            import asyncio
+            import ip2w_asgi
+        except (ImportError, SyntaxError):
+            self.skipTest("asgi variant needs python 3 and httpx")
+        self.asyncio, self.ip2w_asgi = asyncio, ip2w_asgi
+
+    def run_loop(self, *coroutines):
+        """:return: results of coroutines run concurrently in new loop"""
+        loop = self.asyncio.new_event_loop()
+        self.asyncio.set_event_loop(loop)
+        try:
+            results = loop.run_until_complete(self.asyncio.gather(*coroutines))
+            loop.run_until_complete(self.ip2w_asgi.UPSTREAMS.close())
+            return results
+        finally:
+            self.asyncio.set_event_loop(None)
+            loop.close()
+
+    def test_asgi_single_flight(self):
+        """Do concurrent asgi lookups of the same ip wait for one request?"""
+        self.create_app(latency=0.05, CACHE_BACKEND="none")
+        statuses = []
+        responses = self.run_loop(*[
+            self.ip2w_asgi.handle("/ip2w/1.0.0.23", "127.0.0.1",
+                                  lambda status_, headers: statuses.append(status_))
+            for _ in range(10)])
+
+        self.assertEqual(statuses, ["200 OK"] * 10)
+        self.assertEqual(len(set(b"".join(response) for response in responses)), 1)
+        self.assertEqual(self.counts(), (1, 1))
+
+    def test_asgi_upstream_rate_limit(self):
+        """Are asgi lookups over the global limit answered with 429?"""
+        path = tempfile.mktemp()
+        try:
+            self.create_app(RATE_LIMIT_FILE=path, GLOBAL_RATE=0.001, GLOBAL_BURST=1)
+            statuses = []
+            self.run_loop(self.ip2w_asgi.handle(
+                "/ip2w/1.0.0.23", "127.0.0.1",
+                lambda status_, headers: statuses.append(status_)))
+            self.assertEqual(statuses, ["429 Too Many Requests"])
+            self.assertEqual(self.counts(), (1, 0))
+        finally:
+            os.remove(path)
+
+    def test_asgi_method(self):
+        """Are requests other than GET answered with 405?"""
+        self.create_app()
+        messages = []
+        # Tests are parsed by python 2 as well, so no async functions here
+        request = {"type": "http.request", "body": b"[]", "more_body": False}
+        receive = lambda: self.asyncio.sleep(0, request)
+        send = lambda message: self.asyncio.sleep(0, messages.append(message))
+
+        self.run_loop(self.ip2w_asgi.application(
+            {"type": "http", "method": "POST", "path": "/ip2w/",
+             "client": ("127.0.0.1", 1000)}, receive, send))
+        self.assertEqual(messages[0]["status"], 405)
+        self.assertIn((b"allow", b"GET"), messages[0]["headers"])
+        self.assertEqual(json.loads(messages[1]["body"].decode("utf-8")),
+                         {"error": "Method POST is not allowed"})
+        self.assertEqual(self.counts(), (0, 0))
+
+
 if __name__ == "__main__":
     unittest.main()
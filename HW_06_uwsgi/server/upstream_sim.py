@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import json
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+
+from optparse import OptionParser
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+# -------------------------- Constants --------------------------- #
+
+WEATHER_PATH = "/data/2.5/weather"
+
+# Ranges for which ipinfo.io returns no city
+BOGON_RANGES = (
+    ("0.0.0.0", 8), ("10.0.0.0", 8), ("127.0.0.0", 8),
+    ("169.254.0.0", 16), ("172.16.0.0", 12), ("192.168.0.0", 16),
+)
+
+CONDITIONS = (u"ясно", u"облачно", u"небольшой дождь", u"снег", u"туман")
+
+
+# ------------------------- Simulator ---------------------------- #
+
+def ip_to_int(ip_address):
+    return struct.unpack("!I", socket.inet_aton(ip_address))[0]
+
+
+def is_bogon(ip_address):
+    ip = ip_to_int(ip_address)
+    for network, prefix in BOGON_RANGES:
+        if ip >> (32 - prefix) == ip_to_int(network) >> (32 - prefix):
+            return True
+    return False
+
+
+class UpstreamSimulator(object):
+    """
+    Local stand-in of ipinfo.io and openweathermap.org. Every ip belongs
+    to one of synthetic cities, payloads can be replaced from a file.
+    Responses are delayed by latency with jitter and part of them fail
+    with 503.
+    """
+
+    def __init__(self, host="127.0.0.1", port=8090, latency=0.05, jitter=0.01,
+                 error_rate=0.0, cities=100, payloads=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.cities = cities
+        self.payloads = payloads or {}
+        self.counts = {"ipinfo": 0, "weather": 0, "errors": 0}
+        self.lock = threading.Lock()
+
+        self.server = SimulatorServer((host, port), SimulatorHandler)
+        self.server.simulator = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://%s:%s" % self.server.server_address[:2]
+
+    @property
+    def ipinfo_url(self):
+        """Value of IPINFO_URL setting of ip2w"""
+        return self.url + "/{ip_address}"
+
+    @property
+    def weather_url(self):
+        """Value of OPEN_WEATHER_URL setting of ip2w"""
+        return self.url + WEATHER_PATH + \
+            "?q={city},{country}&APPID={token}&lang=ru&units=metric"
+
+    def start(self):
+        """Serve requests in background thread"""
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def geo(self, ip_address):
+        """
+        :return: json of ipinfo.io for ip address
+        """
+        if ip_address in self.payloads.get("ipinfo", {}):
+            return self.payloads["ipinfo"][ip_address]
+        if is_bogon(ip_address):
+            return {"ip": ip_address, "bogon": True}
+        number = ip_to_int(ip_address) % self.cities
+        return {"ip": ip_address, "city": "City %s" % number,
+                "country": "C%s" % (number % 10)}
+
+    def weather(self, city, country):
+        """
+        :return: json of openweathermap.org for city
+        """
+        name = u"%s,%s" % (city, country)
+        if name in self.payloads.get("weather", {}):
+            return self.payloads["weather"][name]
+        number = sum(ord(char) for char in name)
+        return {"name": city,
+                "main": {"temp": number % 60 - 30 + 0.25},
+                "weather": [{"description":
+                             CONDITIONS[number % len(CONDITIONS)]}]}
+
+
+class SimulatorServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+    # Keep connections alive like real upstreams, headers and body are
+    # written separately so without TCP_NODELAY they wait for delayed ack
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        simulator = self.server.simulator
+        time.sleep(max(random.gauss(simulator.latency, simulator.jitter), 0))
+
+        if random.random() < simulator.error_rate:
+            simulator.count("errors")
+            return self.send_json(503, {"message": "simulated error"})
+
+        url = urlparse(self.path)
+        if url.path == WEATHER_PATH:
+            simulator.count("weather")
+            query = parse_qs(url.query).get("q", [""])[0]
+            if isinstance(query, bytes):
+                query = query.decode("utf-8")
+            city, _, country = query.rpartition(",")
+            return self.send_json(200, simulator.weather(city, country))
+
+        simulator.count("ipinfo")
+        try:
+            return self.send_json(200, simulator.geo(url.path.strip("/")))
+        except socket.error:
+            return self.send_json(404, {"error": "Wrong ip"})
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format_, *args):
+        logging.debug(format_ % args)
+
+
+# ---------------------------- Main ----------------------------- #
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-H", "--host", action="store", default="127.0.0.1")
+    op.add_option("-p", "--port", action="store", type=int, default=8090)
+    op.add_option("--latency", action="store", type=float, default=50,
+                  help="mean latency of response in ms")
+    op.add_option("--jitter", action="store", type=float, default=10,
+                  help="standard deviation of latency in ms")
+    op.add_option("--error_rate", action="store", type=float, default=0.0)
+    op.add_option("--cities", action="store", type=int, default=100)
+    op.add_option("--payloads", action="store", default=None,
+                  help="json file with ipinfo and weather payloads")
+    (opts, args) = op.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+
+    payloads_ = None
+    if opts.payloads:
+        with open(opts.payloads) as payloads_file:
+            payloads_ = json.load(payloads_file)
+
+    simulator_ = UpstreamSimulator(opts.host, opts.port, opts.latency / 1000.0,
+                                   opts.jitter / 1000.0, opts.error_rate,
+                                   opts.cities, payloads_)
+    logging.info("IPINFO_URL: %s" % simulator_.ipinfo_url)
+    logging.info("OPEN_WEATHER_URL: %s" % simulator_.weather_url)
+    try:
+        simulator_.server.serve_forever()
+    except KeyboardInterrupt:
+        simulator_.server.server_close()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import bisect
+import gzip
+import logging
+import os
+import random
+
+from itertools import accumulate
+
+from optparse import OptionParser
+
+# ******************** CONSTANTS ******************* #
+
+DEV_TYPES = ("idfa", "gaid", "adid", "dvid")
+DEFAULT_SKEW = "idfa:4,gaid:4,adid:1,dvid:1"
+
+# Kinds of invalid lines, "apps" lines have a wrong app id which loader
+# skips, they are still loaded and are not errors
+INVALID_KINDS = ("format", "device", "geo", "apps")
+
+MAX_APP_ID = 100000
+
+
+# ******************** FUNCTIONS ******************* #
+
+def parse_skew(skew):
+    """
+    :param skew: comma separated device types with their weights, like
+    'idfa:4,gaid:4,adid:1,dvid:1'
+    :return: list of device types and list of their weights
+    """
+    dev_types, weights = [], []
+    for part in skew.split(","):
+        dev_type, _, weight = part.partition(":")
+        if dev_type not in DEV_TYPES:
+            raise ValueError("Unknown device type %s" % dev_type)
+        dev_types.append(dev_type)
+        weights.append(float(weight or 1))
+    return dev_types, weights
+
+
+def make_line(generator, dev_types, cum_weights, apps, invalid_rate):
+    """
+    :param generator: random.Random
+    :param dev_types: list of device types
+    :param cum_weights: list of cumulative weights of device types
+    :param apps: mean number of apps of device
+    :param invalid_rate: share of invalid lines
+    :return: line of appsinstalled file without line end
+    """
+    dev_type = dev_types[bisect.bisect(cum_weights,
+                                       generator.random() * cum_weights[-1])]
+    dev_id = "%032x" % generator.getrandbits(128)
+    lat = "%.6f" % generator.uniform(-90, 90)
+    lon = "%.6f" % generator.uniform(-180, 180)
+    raw_apps = ",".join(str(generator.randint(1, MAX_APP_ID))
+                        for _ in range(generator.randint(1, 2 * apps - 1)))
+
+    if generator.random() < invalid_rate:
+        kind = generator.choice(INVALID_KINDS)
+        if kind == "format":
+            return "\t".join((dev_type, dev_id, lat, lon))
+        if kind == "device":
+            dev_type = "unknown"
+        elif kind == "geo":
+            lat = "lat"
+        else:
+            raw_apps += ",app"
+
+    return "\t".join((dev_type, dev_id, lat, lon, raw_apps))
+
+
+def generate_file(path, lines, options, seed):
+    """
+    :param path: path of gzip file
+    :param lines: number of lines
+    :param options: options from OptionsParser
+    :param seed: seed of random generator of the file
+    """
+    generator = random.Random(seed)
+    dev_types, weights = parse_skew(options.skew)
+    cum_weights = list(accumulate(weights))
+    with gzip.open(path, "wt", compresslevel=options.compress) as fd:
+        for _ in range(lines):
+            fd.write(make_line(generator, dev_types, cum_weights, options.apps,
+                               options.invalid_rate) + "\n")
+
+
+def generate(options):
+    """
+    :param options: options from OptionsParser
+    :return: list of paths of generated files
+    """
+    if not os.path.isdir(options.output):
+        os.makedirs(options.output)
+
+    paths = []
+    for number in range(options.files):
+        path = os.path.join(options.output,
+                            "appsinstalled-%03d.tsv.gz" % number)
+        logging.info("Generating %s" % path)
+        generate_file(path, options.lines, options, options.seed + number)
+        paths.append(path)
+    return paths
+
+
+# ******************** MAIN ******************* #
+
+if __name__ == '__main__':
+    op = OptionParser()
+    op.add_option("-o", "--output", action="store", default=".")
+    op.add_option("--files", action="store", type="int", default=1)
+    op.add_option("--lines", action="store", type="int", default=100000)
+    op.add_option("--apps", action="store", type="int", default=20,
+                  help="mean number of apps of device")
+    op.add_option("--invalid_rate", action="store", type="float", default=0.001)
+    op.add_option("--skew", action="store", default=DEFAULT_SKEW,
+                  help="weights of device types")
+    op.add_option("--compress", action="store", type="int", default=6,
+                  help="gzip compression level")
+    op.add_option("--seed", action="store", type="int", default=1)
+    (opts, args) = op.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    generate(opts)
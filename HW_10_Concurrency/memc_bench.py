@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import glob
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser, Values
+
+import memc_multi_load
+from appsinstalled_gen import DEFAULT_SKEW, generate
+from memc_sim import MemcSimulator
+
+# ******************** CONSTANTS ******************* #
+
+DEFAULT_WORKERS = "1,2,4"
+DEFAULT_ENGINES = "sync,asyncio"
+
+# Options of loader which are the same for all runs
+LOADER_OPTIONS = {
+    "dry": False,
+    "per_file": False,
+    "retries": memc_multi_load.RETRIES,
+    "dead_letter": None,
+    "checkpoint": memc_multi_load.CHECKPOINT_BLOCKS,
+    "resume": False,
+}
+
+
+# ******************** FUNCTIONS ******************* #
+
+def restore_files(directory):
+    """
+    :param directory: directory of generated files
+
+    Loader renames loaded files, they get their names back for next run
+    """
+    for path in glob.glob(os.path.join(directory, ".*.tsv.gz")):
+        head, fn = os.path.split(path)
+        os.rename(path, os.path.join(head, fn[1:]))
+
+
+def run_load(simulator, directory, options, engine, workers):
+    """
+    :param simulator: running MemcSimulator
+    :param directory: directory of generated files
+    :param options: options from OptionsParser
+    :param engine: engine of loader
+    :param workers: number of workers of loader
+    :return: dictionary with results of the run
+    """
+    restore_files(directory)
+    summary = os.path.join(directory, "summary.json")
+    loader_options = Values(dict(
+        LOADER_OPTIONS, pattern=os.path.join(directory, "*.tsv.gz"),
+        log=options.log, workers=workers, engine=engine,
+        per_file=options.per_file, summary=summary,
+        **simulator.addresses))
+
+    stored, failed = simulator.stored.value, simulator.failed.value
+    start = time.time()
+    memc_multi_load.main(loader_options)
+    duration = time.time() - start
+
+    with open(summary) as fd:
+        report = json.load(fd)
+
+    return {
+        "engine": engine,
+        "workers": workers,
+        "per_file": options.per_file,
+        "duration": round(duration, 3),
+        "lines": report["lines"],
+        "lines_per_sec": round(report["lines"] / duration, 1),
+        "mb_per_sec": round(report["bytes"] / duration / 1024 ** 2, 2),
+        "stored": simulator.stored.value - stored,
+        "not_stored": simulator.failed.value - failed,
+        "seconds": report["seconds"],
+        "workers_busy": report["workers_busy"],
+    }
+
+
+def print_report(results):
+    """
+    :param results: list with results of runs
+    """
+    line = "{:<8} {:>7} {:>10} {:>12} {:>8} {:>10}"
+    print(line.format("engine", "workers", "duration", "lines/sec",
+                      "MB/sec", "stored"), file=sys.stderr)
+    for result in results:
+        print(line.format(result["engine"], result["workers"],
+                          result["duration"], result["lines_per_sec"],
+                          result["mb_per_sec"], result["stored"]),
+              file=sys.stderr)
+
+
+def main(options):
+    """
+    :param options: options from OptionsParser
+    :return: dictionary with description of the run and results of loads
+    """
+    engines = options.engines.split(",")
+    for engine in engines:
+        if engine not in memc_multi_load.ENGINES:
+            raise ValueError("Unknown engine {}".format(engine))
+    workers_levels = [int(level) for level in options.workers.split(",")]
+
+    directory = tempfile.mkdtemp(prefix="memc_bench")
+    simulator = MemcSimulator(port=options.port,
+                              fail_rate=options.fail_rate).start()
+
+    results = []
+    try:
+        generate(Values({"output": directory, "files": options.files,
+                         "lines": options.lines, "apps": options.apps,
+                         "invalid_rate": options.invalid_rate,
+                         "skew": options.skew, "compress": 6,
+                         "seed": options.seed}))
+        for engine in engines:
+            for workers in workers_levels:
+                print("Running {} engine with {} workers".format(
+                    engine, workers), file=sys.stderr)
+                results.append(run_load(simulator, directory, options,
+                                        engine, workers))
+    finally:
+        simulator.stop()
+        shutil.rmtree(directory)
+
+    return {
+        "python": sys.version.split()[0],
+        "cpu_count": os.cpu_count(),
+        "files": options.files,
+        "lines": options.lines,
+        "apps": options.apps,
+        "invalid_rate": options.invalid_rate,
+        "skew": options.skew,
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+
+
+# ******************** MAIN ******************* #
+
+if __name__ == '__main__':
+    op = OptionParser()
+    op.add_option("--files", action="store", type="int", default=4)
+    op.add_option("--lines", action="store", type="int", default=100000,
+                  help="number of lines of every file")
+    op.add_option("--apps", action="store", type="int", default=20)
+    op.add_option("--invalid_rate", action="store", type="float", default=0.001)
+    op.add_option("--skew", action="store", default=DEFAULT_SKEW)
+    op.add_option("-w", "--workers", action="store", default=DEFAULT_WORKERS)
+    op.add_option("--engines", action="store", default=DEFAULT_ENGINES)
+    op.add_option("--per_file", action="store_true", default=False)
+    op.add_option("-p", "--port", action="store", type="int", default=33113,
+                  help="port of memcached simulator for idfa, next ports "
+                       "are for gaid, adid and dvid")
+    op.add_option("--fail_rate", action="store", type="float", default=0.0)
+    op.add_option("--seed", action="store", type="int", default=1)
+    op.add_option("--log", action="store", default=os.devnull,
+                  help="file for logs of generator and loader")
+    op.add_option("-o", "--output", action="store", default=None)
+    (opts, args) = op.parse_args()
+
+    logging.basicConfig(filename=opts.log, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+
+    report = main(opts)
+    print_report(report["results"])
+
+    if opts.output:
+        with open(opts.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -1,28 +1,76 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import asyncio
+import bisect
 import collections
 import glob
 import gzip
+import json
 import logging
 import os
+import random
+import re
+import socket
 import sys
+import time
 
-from itertools import islice
-from multiprocessing import Array, JoinableQueue, Lock, Process
+from array import array
+from itertools import accumulate
+from multiprocessing import Pool, Process, Queue, RawArray
 from optparse import OptionParser
 
 import appsinstalled_pb2
-import memcache
 
 # ******************** CONSTANTS ******************* #
 
-AppsInstalled = collections.namedtuple(
-    "AppsInstalled",
-    ["dev_type", "dev_id", "lat", "lon", "apps"]
-)
+# Codes of device types in parsed blocks
+DEV_TYPES = ("idfa", "gaid", "adid", "dvid")
+DEV_TYPE_CODES = dict((name.encode("ascii"), code)
+                      for code, name in enumerate(DEV_TYPES))
+
+# Flags of lines in parsed blocks, lines with BAD_APPS are loaded
+# without apps which are not numbers
+BAD_FORMAT = 1
+UNKNOWN_DEVICE = 2
+BAD_GEO = 4
+BAD_APPS = 8
+NOT_LOADED = BAD_FORMAT | UNKNOWN_DEVICE | BAD_GEO
 
 NORMAL_ERR_RATE = 0.01
-PACKAGE_SIZE = 400
+BLOCK_SIZE = 1024 * 1024
+
+# Values are sent to memcached in batches of this size, several batches
+# of every connection wait for answers at once
+BATCH_BYTES = 64 * 1024
+PIPELINE_DEPTH = 4
+MEMC_TIMEOUT = 3
+
+# Engines of workers: sync sends batches of one device at a time, asyncio
+# sends batches of all devices at once, up to ASYNC_PIPELINE_DEPTH batches
+# of every device wait for answers
+ENGINES = ("sync", "asyncio")
+ASYNC_PIPELINE_DEPTH = 16
+
+# Keys which memcached text protocol does not accept
+BAD_KEY = re.compile(br"[\x00-\x20\x7f]")
+MAX_KEY_LENGTH = 250
+
+# Failed keys are sent again after random delay up to RETRY_BACKOFF * 2 **
+# (number of failures of memcached in a row), but not longer than
+# RETRY_BACKOFF_MAX seconds
+RETRIES = 3
+RETRY_BACKOFF = 0.1
+RETRY_BACKOFF_MAX = 5
+
+# State of file is saved to sidecar file after every CHECKPOINT_BLOCKS
+# blocks, so load can be resumed from the last checkpoint
+CHECKPOINT_BLOCKS = 64
+STATE_SUFFIX = ".state"
+
+# Upper bounds of buckets of set_multi latency histograms in ms, the last
+# bucket is for longer calls
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+PROGRESS_INTERVAL = 10
 
 
 # ******************** FUNCTIONS ******************* #
@@ -33,77 +81,977 @@ def dot_rename(path):
     os.rename(path, os.path.join(head, "." + fn))
 
 
-def insert_appsinstalled(app_type, memc_client, apps, dry_run=False):
+def new_state():
     """
-    :param app_type: type of app device in processed file
-    :param memc_client: memcached connection client appropriate to app_type
-    :param apps: apps information to store in memcached
-    :param dry_run: if dry_run is True memcached load is idle, only logging is up
-    :return: number of keys which have not loaded to memcached
+    :return: state of file which is not loaded yet, offset is position in
+    decompressed file after the last loaded block
+    """
+    return {"offset": 0, "lines": 0, "errors": 0, "processed": 0,
+            "done": False}
+
 
-    Function creates key-value pairs and store them in memcached. It gets
-    only one app_type information and appropriate memcached client.
+def read_state(path):
     """
+    :param path: path of gzip file
+    :return: state of file from its sidecar file or new state
+    """
+    try:
+        with open(path + STATE_SUFFIX) as fd:
+            return json.load(fd)
+    except (IOError, ValueError):
+        return new_state()
 
-    package, log_package = {}, []
 
-    # Process apps and create key, value pairs
-    for appsinstalled in apps:
-        ua = appsinstalled_pb2.UserApps()
-        ua.lat = appsinstalled.lat
-        ua.lon = appsinstalled.lon
-        key = "%s:%s" % (appsinstalled.dev_type, appsinstalled.dev_id)
-        ua.apps.extend(appsinstalled.apps)
+def write_state(path, state):
+    """
+    :param path: path of gzip file
+    :param state: state of file to save in its sidecar file
+    """
+    temp_path = path + STATE_SUFFIX + ".tmp"
+    with open(temp_path, "w") as fd:
+        json.dump(state, fd)
+    # atomic in most cases
+    os.replace(temp_path, path + STATE_SUFFIX)
+
+
+def open_file(path, options):
+    """
+    :param path: path of gzip file
+    :param options: options from OptionsParser
+    :return: gzip file and its state, with options.resume file is opened
+    after the last checkpoint
+    """
+    state = read_state(path) if options.resume else new_state()
+    if state["offset"]:
+        logging.info("Resume %s from line %s" % (path, state["lines"]))
+    fd = gzip.open(path, 'rb')
+    fd.seek(state["offset"])
+    return fd, state
+
+
+def count_lines(block):
+    return block.count(b"\n") + (not block.endswith(b"\n"))
+
+
+def finish_file(path, errors, processed):
+    """
+    :param path: path of loaded gzip file
+    :param errors: number of errors in file
+    :param processed: number of lines of file loaded to memcached
+
+    Function checks error rate and renames file, state of renamed file is
+    not needed any more
+    """
+    check_error_rate(errors, processed)
+    dot_rename(path)
+    if os.path.exists(path + STATE_SUFFIX):
+        os.remove(path + STATE_SUFFIX)
+
+
+class BlockRing(object):
+    """
+    Ring of slots in shared memory for blocks of files. Producer writes a
+    block to a free slot and sends only number of the slot and length of
+    the block through queue, worker copies the block and frees the slot at
+    once. Producer waits for a free slot, so only slots number of blocks
+    are read ahead.
+    """
+
+    def __init__(self, slots, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.buffer = RawArray('c', slots * block_size)
+        self.free_slots = Queue()
+        for slot in range(slots):
+            self.free_slots.put(slot)
+
+    def put(self, block):
+        """
+        :param block: bytes not longer than block_size
+        :return: number of slot and length of block to send to worker
+        """
+        slot = self.free_slots.get()
+        start = slot * self.block_size
+        memoryview(self.buffer).cast('B')[start:start + len(block)] = block
+        return slot, len(block)
+
+    def get(self, slot, length):
+        """
+        :return: bytes of block from slot, the slot becomes free
+        """
+        start = slot * self.block_size
+        view = memoryview(self.buffer).cast('B')
+        block = view[start:start + length].tobytes()
+        self.free_slots.put(slot)
+        return block
+
+
+def read_blocks(fd, block_size=BLOCK_SIZE):
+    """
+    :param fd: file opened in binary mode
+    :param block_size: max size of block
+    :return: generator of blocks of whole lines
+
+    Lines longer than block_size are cut into blocks and become errors
+    """
+    rest = b""
+    while True:
+        data = rest + fd.read(block_size - len(rest))
+        if len(data) == len(rest):
+            if rest:
+                yield rest
+            return
+
+        end = data.rfind(b"\n") + 1 or len(data)
+        yield data[:end]
+        rest = data[end:]
+
+
+class AppsColumns(object):
+    """
+    Lines of block parsed to columns, i-th item of every column belongs to
+    i-th line. Apps of i-th line are apps[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self):
+        self.dev_types = array('b')
+        self.dev_ids = []
+        self.lats = array('d')
+        self.lons = array('d')
+        self.offsets = array('l', [0])
+        self.apps = array('I')
+        self.flags = array('b')
+
+    def __len__(self):
+        return len(self.flags)
+
+    def rows(self, dev_type):
+        """
+        :return: numbers of lines of dev_type which can be loaded
+        """
+        return [row for row, (code, flags) in
+                enumerate(zip(self.dev_types, self.flags))
+                if code == dev_type and not flags & NOT_LOADED]
+
+
+def parse_apps(raw_apps):
+    """
+    :param raw_apps: bytes with comma separated apps
+    :return: list of apps and True if all of them are numbers
+    """
+    try:
+        apps = [int(app) for app in raw_apps.split(b",")]
+        if all(0 <= app < 2 ** 32 for app in apps):
+            return apps, True
+    except ValueError:
+        pass
+    apps = [int(app) for app in raw_apps.split(b",") if app.strip().isdigit()]
+    return [app for app in apps if app < 2 ** 32], False
+
+
+def parse_block(block):
+    """
+    :param block: bytes of whole lines
+    :return: AppsColumns with all lines of block
+
+    Lines are split to fields and fields are transposed to columns, then
+    every column of the whole block is converted to array by one call.
+    Lines are converted one by one only when the block has wrong numbers,
+    to find and flag them.
+    """
+    columns = AppsColumns()
+    lines = block.splitlines()
+    if not lines:
+        return columns
+
+    fields = [line.strip().split(b"\t") for line in lines]
+    flags = array('b', bytes(len(fields)))
+    for row, line_parts in enumerate(fields):
+        if len(line_parts) != 5 or not line_parts[0] or not line_parts[1]:
+            fields[row] = (b"", b"", b"0", b"0", b"")
+            flags[row] = BAD_FORMAT
+
+    dev_types, columns.dev_ids, raw_lats, raw_lons, raw_apps = zip(*fields)
+    columns.dev_types = array('b', [DEV_TYPE_CODES.get(dev_type, -1)
+                                    for dev_type in dev_types])
+    for row, code in enumerate(columns.dev_types):
+        if code < 0 and not flags[row]:
+            flags[row] = UNKNOWN_DEVICE
+    columns.flags = flags
+
+    try:
+        columns.lats = array('d', map(float, raw_lats))
+        columns.lons = array('d', map(float, raw_lons))
+    except ValueError:
+        columns.lats, columns.lons = array('d'), array('d')
+        for row, (lat, lon) in enumerate(zip(raw_lats, raw_lons)):
+            try:
+                lat, lon = float(lat), float(lon)
+            except ValueError:
+                logging.info("Invalid geo coords: `%s`" %
+                             lines[row].decode("utf-8", "replace"))
+                lat, lon = 0.0, 0.0
+                flags[row] |= BAD_GEO
+            columns.lats.append(lat)
+            columns.lons.append(lon)
+
+    raw_apps = [raw if not flags[row] else None
+                for row, raw in enumerate(raw_apps)]
+    loaded = [raw for raw in raw_apps if raw is not None]
+    try:
+        columns.apps = array('I', map(int, b",".join(loaded).split(b","))) \
+            if loaded else array('I')
+        columns.offsets.extend(accumulate(
+            raw.count(b",") + 1 if raw is not None else 0 for raw in raw_apps))
+    except (ValueError, OverflowError):
+        columns.apps = array('I')
+        for row, raw in enumerate(raw_apps):
+            if raw is not None:
+                apps, correct = parse_apps(raw)
+                if not correct:
+                    logging.info("Not all user apps are digits: `%s`" %
+                                 lines[row].decode("utf-8", "replace"))
+                    flags[row] |= BAD_APPS
+                columns.apps.extend(apps)
+            columns.offsets.append(len(columns.apps))
+
+    return columns
+
+
+def build_commands(mapping):
+    """
+    :param mapping: dictionary of keys and bytes values
+    :return: set commands of memcached text protocol, keys of the commands
+    and keys which memcached does not accept
+    """
+    commands, keys, invalid = [], [], []
+    for key, value in mapping.items():
+        raw_key = key.encode("utf-8")
+        if len(raw_key) > MAX_KEY_LENGTH or BAD_KEY.search(raw_key):
+            invalid.append(key)
+            continue
+        commands.append(b"set %s 0 0 %d\r\n%s\r\n" %
+                        (raw_key, len(value), value))
+        keys.append(key)
+    return b"".join(commands), keys, invalid
+
+
+def valid_key(key):
+    """
+    :param key: key of memcached
+    :return: True if memcached text protocol accepts the key
+    """
+    raw_key = key.encode("utf-8")
+    return len(raw_key) <= MAX_KEY_LENGTH and not BAD_KEY.search(raw_key)
+
+
+class MemcClient(object):
+    """
+    Connection of one worker to one memcached. Every set_multi sends batch
+    of set commands without waiting for answers to previous batches, only
+    when more than depth batches wait answers of the oldest one are read.
+    flush reads all answers. On connection errors all waiting keys fail and
+    the next batch connects again.
+    """
+
+    def __init__(self, servers, depth=PIPELINE_DEPTH, timeout=MEMC_TIMEOUT):
+        host, port = servers[0].rsplit(":", 1)
+        self.address = (host, int(port))
+        self.depth = depth
+        self.timeout = timeout
+        self.sock = None
+        self.answers = None
+        self.in_flight = collections.deque()
+
+    def connect(self):
+        self.sock = socket.create_connection(self.address, self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.answers = self.sock.makefile("rb")
+
+    def close(self):
+        if self.sock is not None:
+            self.answers.close()
+            self.sock.close()
+        self.sock, self.answers = None, None
+
+    def fail(self, error):
+        """
+        :return: keys of all batches waiting for answers
+        """
+        logging.error("Cannot write to memc %s:%s: %s" %
+                      (self.address + (error,)))
+        self.close()
+        failed = [key for keys in self.in_flight for key in keys]
+        self.in_flight.clear()
+        return failed
+
+    def read_batch(self):
+        """
+        :return: keys of the oldest batch which memcached did not store
+
+        The batch stays waiting until all its answers are read, so on
+        errors in the middle of it fail returns all its keys.
+        """
+        keys = self.in_flight[0]
+        failed = []
+        for key in keys:
+            answer = self.answers.readline()
+            if not answer:
+                raise socket.error("connection closed by memcached")
+            if answer != b"STORED\r\n":
+                failed.append(key)
+        self.in_flight.popleft()
+        return failed
+
+    def set_multi(self, mapping):
+        """
+        :param mapping: dictionary of keys and bytes values
+        :return: keys which were not stored from batches answered so far
+        """
+        commands, keys, failed = build_commands(mapping)
+
+        self.in_flight.append(keys)
+        try:
+            if self.sock is None:
+                self.connect()
+            self.sock.sendall(commands)
+            while len(self.in_flight) > self.depth:
+                failed.extend(self.read_batch())
+        except (socket.error, OSError) as e:
+            failed.extend(self.fail(e))
+        return failed
+
+    def flush(self):
+        """
+        :return: keys which were not stored from all waiting batches
+        """
+        failed = []
+        try:
+            while self.in_flight:
+                failed.extend(self.read_batch())
+        except (socket.error, OSError) as e:
+            failed.extend(self.fail(e))
+        return failed
+
+
+def drop_invalid(app_type, failed, values, dead_letter=None):
+    """
+    :param app_type: type of app device of memcached
+    :param failed: keys which were not stored
+    :param values: dictionary with values of the keys
+    :param dead_letter: directory for dead letter files or None
+    :return: failed keys which may be stored on retry and invalid keys
+
+    Memcached never accepts invalid keys, so they are not retried and are
+    written to dead letter file at once.
+    """
+    invalid = [key for key in failed if not valid_key(key)]
+    if not invalid:
+        return failed, invalid
+    logging.error("Cannot write %s invalid keys to memc %s" %
+                  (len(invalid), app_type))
+    if dead_letter is not None:
+        write_dead_letter(dead_letter, app_type,
+                          [(key, values[key]) for key in invalid])
+    return set(failed).difference(invalid), invalid
+
+
+def backoff(failures):
+    """
+    :param failures: number of failures of memcached in a row
+    :return: random delay before retry in seconds
+    """
+    return random.uniform(0, min(RETRY_BACKOFF * 2 ** failures, RETRY_BACKOFF_MAX))
+
+
+class RetryClient(object):
+    """
+    Wrapper of memcached client which keeps values until they are stored.
+    flush sends failed keys again with bounded exponential backoff, delay
+    grows while memcached fails and is reset when it stores all keys. Keys
+    which fail all retries are written to dead letter file of the worker.
+    """
+
+    def __init__(self, app_type, client, retries=RETRIES, dead_letter=None):
+        """
+        :param app_type: type of app device of memcached
+        :param client: memcached client, flush method is optional
+        :param retries: number of retries of failed keys
+        :param dead_letter: directory for dead letter files, if it is None
+        keys are only counted as failed
+        """
+        self.app_type = app_type
+        self.client = client
+        self.retries = retries
+        self.dead_letter = dead_letter
+        self.sent = {}
+        self.failed = set()
+        self.failures = 0
+
+    def send(self, mapping):
+        """
+        :return: keys of mapping which client reports as failed
+        """
+        try:
+            return self.client.set_multi(mapping)
+        except Exception as e:
+            logging.exception("Cannot write to memc %s: %s" % (self.app_type, e))
+            return list(mapping)
+
+    def wait(self):
+        """
+        :return: keys which client reports as failed after all answers
+        """
+        flush = getattr(self.client, "flush", None)
+        return flush() if flush is not None else []
+
+    def close(self):
+        """Close connection of client, close method is optional"""
+        close = getattr(self.client, "close", None)
+        if close is not None:
+            close()
+
+    def set_multi(self, mapping):
+        """
+        :return: empty list, failed keys are returned by flush after retries
+        """
+        self.sent.update(mapping)
+        self.failed.update(self.send(mapping))
+        return []
+
+    def flush(self):
+        """
+        :return: keys which have not been stored after all retries
+        """
+        failed, invalid = drop_invalid(self.app_type,
+                                       self.failed.union(self.wait()),
+                                       self.sent, self.dead_letter)
+        for attempt in range(self.retries):
+            if not failed:
+                break
+            self.failures += 1
+            time.sleep(backoff(self.failures))
+            logging.info("Retry %s keys of memc %s" % (len(failed), self.app_type))
+            failed = set(self.send(dict((key, self.sent[key]) for key in failed)))
+            failed.update(self.wait())
+
+        if failed:
+            logging.error("Cannot write %s keys to memc %s after %s retries" %
+                          (len(failed), self.app_type, self.retries))
+            if self.dead_letter is not None:
+                write_dead_letter(self.dead_letter, self.app_type,
+                                  [(key, self.sent[key]) for key in failed])
+        else:
+            self.failures = 0
+
+        self.sent, self.failed = {}, set()
+        return list(failed) + invalid
+
+
+def dead_letter_line(key, packed):
+    """
+    :param key: key of memcached in format dev_type:dev_id
+    :param packed: serialized UserApps
+    :return: line of appsinstalled file with the same values
+    """
+    dev_type, dev_id = key.split(":", 1)
+    ua = appsinstalled_pb2.UserApps()
+    ua.ParseFromString(packed)
+    return "%s\t%s\t%r\t%r\t%s\n" % (dev_type, dev_id, ua.lat, ua.lon,
+                                     ",".join(str(app) for app in ua.apps))
+
+
+def write_dead_letter(directory, app_type, items):
+    """
+    :param directory: directory of dead letter files
+    :param app_type: type of app device of items
+    :param items: list of keys and serialized values
+
+    Every process appends to its own file, every write is a separate gzip
+    member, so the file stays readable if the process is terminated. The
+    files can be loaded again with --pattern.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "%s-%s.tsv.gz" % (app_type, os.getpid()))
+    with gzip.open(path, "ab") as fd:
+        fd.write("".join(dead_letter_line(key, packed)
+                         for key, packed in items).encode("utf-8"))
+    logging.info("%s keys are written to %s" % (len(items), path))
+
+
+class AsyncMemcClient(object):
+    """
+    Asyncio connection of one worker to one memcached. Concurrent calls of
+    set_multi write their batches one after another under lock and read
+    answers in order of writes, up to depth batches wait for answers. On
+    errors all keys of the batch fail and the connection is closed, so
+    batches waiting for answers on it fail too and the next batch connects
+    again.
+    """
+
+    def __init__(self, servers, depth=ASYNC_PIPELINE_DEPTH, timeout=MEMC_TIMEOUT):
+        host, port = servers[0].rsplit(":", 1)
+        self.address = (host, int(port))
+        self.depth = depth
+        self.timeout = timeout
+        self.connection = None
+        self.last_batch = None
+        self.slots = None
+        self.writing = None
+        self.failures = 0
+
+    async def write(self, commands, done):
+        """
+        :param commands: set commands of batch
+        :param done: future of batch which is done when its answers are read
+        :return: connection and future of previous batch on it
+
+        Only one batch is written at a time, so batches are not mixed and
+        drain is not called concurrently. Connection is opened by the first
+        batch which needs it.
+        """
+        async with self.writing:
+            if self.connection is None:
+                self.connection = await asyncio.wait_for(
+                    asyncio.open_connection(*self.address), self.timeout)
+                self.last_batch = None
+            connection = self.connection
+            previous, self.last_batch = self.last_batch, done
+            connection[1].write(commands)
+            try:
+                await asyncio.wait_for(connection[1].drain(), self.timeout)
+            except Exception:
+                # Batches after this one must not wait for it
+                if not done.done():
+                    done.set_result(None)
+                raise
+            return connection, previous
+
+    def close(self, connection, error):
+        logging.error("Cannot write to memc %s:%s: %s" %
+                      (self.address + (error,)))
+        if self.connection is connection:
+            self.connection = None
+        connection[1].close()
+
+    async def read_answers(self, reader, keys, previous):
+        """
+        :return: keys which memcached did not store, answers are read after
+        answers of previous batch
+        """
+        if previous is not None:
+            await previous
+        failed = []
+        for key in keys:
+            if await reader.readline() != b"STORED\r\n":
+                failed.append(key)
+        return failed
+
+    async def set_multi(self, mapping):
+        """
+        :param mapping: dictionary of keys and bytes values
+        :return: keys which were not stored
+        """
+        commands, keys, failed = build_commands(mapping)
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.depth)
+            self.writing = asyncio.Lock()
+
+        async with self.slots:
+            done = asyncio.get_event_loop().create_future()
+            connection = self.connection
+            try:
+                connection, previous = await self.write(commands, done)
+                failed.extend(await asyncio.wait_for(
+                    self.read_answers(connection[0], keys, previous),
+                    self.timeout))
+            except Exception as e:
+                if connection is not None:
+                    self.close(connection, e)
+                else:
+                    logging.error("Cannot connect to memc %s:%s: %s" %
+                                  (self.address + (e,)))
+                failed.extend(keys)
+            finally:
+                if not done.done():
+                    done.set_result(None)
+        return failed
+
 
-        if dry_run:
-            log_package.append((key, ua))
+class AsyncLoader(object):
+    """
+    Event loop of worker with asyncio clients of every device. Batches of
+    all devices of block are sent at once, failed keys are retried with
+    bounded exponential backoff and written to dead letter file like in
+    RetryClient.
+    """
+
+    def __init__(self, device_memc, options):
+        # Clients create futures, locks and connections of the current loop
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.clients = dict((key, AsyncMemcClient([address]))
+                            for key, address in device_memc.items())
+        self.options = options
+
+    def close(self):
+        for client in self.clients.values():
+            if client.connection is not None:
+                client.connection[1].close()
+                client.connection = None
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+    def load(self, columns):
+        """
+        :param columns: AppsColumns of parsed block
+        :return: number of lines loaded to memcached
+        """
+        return self.loop.run_until_complete(self.load_columns(columns))
+
+    async def load_columns(self, columns):
+        loaded, tasks = 0, []
+        for code, app_type in enumerate(DEV_TYPES):
+            rows = columns.rows(code)
+            if not rows or app_type not in self.clients:
+                continue
+            loaded += len(rows)
+            if self.options.dry:
+                insert_appsinstalled(app_type, None, columns, rows, True)
+                continue
+
+            package = dict((key, ua.SerializeToString())
+                           for key, ua in pack_rows(app_type, columns, rows))
+            tasks.extend(self.store(app_type, batch)
+                         for batch in split_batches(package))
+
+        failed = await asyncio.gather(*tasks)
+        return loaded - sum(failed)
+
+    async def store(self, app_type, batch):
+        """
+        :return: number of keys of batch which have not been stored after
+        all retries
+        """
+        client = self.clients[app_type]
+        start = time.time()
+        failed = await client.set_multi(batch)
+        METRICS.observe(app_type, time.time() - start)
+        failed, invalid = drop_invalid(app_type, failed, batch,
+                                       self.options.dead_letter)
+
+        for attempt in range(self.options.retries):
+            if not failed:
+                break
+            client.failures += 1
+            await asyncio.sleep(backoff(client.failures))
+            logging.info("Retry %s keys of memc %s" % (len(failed), app_type))
+            failed = await client.set_multi(dict((key, batch[key]) for key in failed))
+
+        if failed:
+            logging.error("Cannot write %s keys to memc %s after %s retries" %
+                          (len(failed), app_type, self.options.retries))
+            if self.options.dead_letter is not None:
+                write_dead_letter(self.options.dead_letter, app_type,
+                                  [(key, batch[key]) for key in failed])
         else:
-            packed = ua.SerializeToString()
-            package.update({key: packed})
+            client.failures = 0
+        return len(failed) + len(invalid)
+
+
+def create_clients(device_memc, client_class, options):
+    """
+    :param device_memc: memcached addresses for each app device
+    :param client_class: class of memcached client
+    :param options: options from OptionsParser
+    :return: dictionary with memcached clients which retry failed keys, with
+    asyncio engine AsyncLoader with asyncio clients
+    """
+    if getattr(options, "engine", "sync") == "asyncio":
+        return AsyncLoader(device_memc, options)
+    return dict((key, RetryClient(key, client_class([address]),
+                                  options.retries, options.dead_letter))
+                for key, address in device_memc.items())
+
+
+def close_clients(memc_clients):
+    """
+    :param memc_clients: dictionary with memcached clients or AsyncLoader
+    from create_clients
+    """
+    if isinstance(memc_clients, AsyncLoader):
+        memc_clients.close()
+        return
+    for client in memc_clients.values():
+        client.close()
+
+
+def insert_appsinstalled(app_type, memc_client, columns, rows, dry_run=False):
+    """
+    :param app_type: type of app device in processed file
+    :param memc_client: memcached connection client appropriate to app_type
+    :param columns: AppsColumns of parsed block
+    :param rows: numbers of lines of app_type in columns
+    :param dry_run: if dry_run is True memcached load is idle, only logging is up
+    :return: number of keys which have not loaded to memcached, with
+    pipelined client only answered keys are counted, others are counted
+    by flush of the client
+
+    Function creates key-value pairs and store them in memcached in batches
+    of BATCH_BYTES. It gets only one app_type information and appropriate
+    memcached client.
+    """
 
     # Loading or only logging
     if dry_run:
-        for key, ua in log_package:
+        for key, ua in pack_rows(app_type, columns, rows):
             logging.debug("%s - %s -> %s" %
                           (app_type, key, str(ua).replace("\n", " ")))
     else:
-        try:
-            return len(memc_client.set_multi(package))
-        except Exception as e:
-            logging.exception("Cannot write to memc %s: %s" % (app_type, e))
-            return len(apps)
+        package = dict((key, ua.SerializeToString())
+                       for key, ua in pack_rows(app_type, columns, rows))
+        return sum(send_batch(app_type, memc_client, batch)
+                   for batch in split_batches(package))
 
+    return 0
 
-def parse_appsinstalled(line):
-    line_parts = line.strip().split("\t")
-    if len(line_parts) < 5:
-        return
-    dev_type, dev_id, lat, lon, raw_apps = line_parts
-    if not dev_type or not dev_id:
-        return
-    try:
-        apps = [int(a.strip()) for a in raw_apps.split(",")]
-    except ValueError:
-        apps = [int(a.strip()) for a in raw_apps.split(",") if a.isidigit()]
-        logging.info("Not all user apps are digits: `%s`" % line)
+
+def pack_rows(app_type, columns, rows):
+    """
+    :param app_type: type of app device of rows
+    :param columns: AppsColumns of parsed block
+    :param rows: numbers of lines in columns
+    :return: generator of keys and UserApps of rows
+    """
+    offsets, apps = columns.offsets, columns.apps
+    for row in rows:
+        ua = appsinstalled_pb2.UserApps()
+        ua.lat = columns.lats[row]
+        ua.lon = columns.lons[row]
+        ua.apps.extend(apps[offsets[row]:offsets[row + 1]])
+        yield "%s:%s" % (app_type, columns.dev_ids[row].decode("utf-8", "replace")), ua
+
+
+def split_batches(package, batch_bytes=BATCH_BYTES):
+    """
+    :param package: dictionary of keys and packed values
+    :param batch_bytes: size of batch
+    :return: generator of parts of package not much larger than batch_bytes
+    """
+    batch, batch_size = {}, 0
+    for key, packed in package.items():
+        batch[key] = packed
+        batch_size += len(key) + len(packed)
+        if batch_size >= batch_bytes:
+            yield batch
+            batch, batch_size = {}, 0
+    if batch:
+        yield batch
+
+
+def send_batch(app_type, memc_client, batch):
+    """
+    :return: number of keys of batch which have not loaded to memcached
+    """
+    start = time.time()
     try:
-        lat, lon = float(lat), float(lon)
-    except ValueError:
-        logging.info("Invalid geo coords: `%s`" % line)
-    return AppsInstalled(dev_type, dev_id, lat, lon, apps)
+        return len(memc_client.set_multi(batch))
+    except Exception as e:
+        logging.exception("Cannot write to memc %s: %s" % (app_type, e))
+        return len(batch)
+    finally:
+        METRICS.observe(app_type, time.time() - start)
 
 
-def process_file(io_queue, file_stats, device_memc, memc_clients, options, lock):
+class Metrics(object):
+    """
+    Counters of process: seconds of every stage of load, numbers of lines
+    and bytes and histograms of set_multi latency for every device type.
+    Workers send their metrics to producer with stats of blocks.
+
+    Stages are read (decompression), ipc (waiting for free slot of ring),
+    wait (waiting for stats of blocks), parse, load (serialization,
+    set_multi and answers of memcached), busy and idle (worker processes
+    block or waits for it)
+    """
+
+    def __init__(self):
+        self.seconds = collections.Counter()
+        self.counts = collections.Counter()
+        self.latency = {}
+
+    def observe(self, app_type, seconds):
+        histogram = self.latency.setdefault(
+            app_type, [0] * (len(LATENCY_BUCKETS) + 1))
+        histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds * 1000)] += 1
+
+    def merge(self, other):
+        self.seconds.update(other.seconds)
+        self.counts.update(other.counts)
+        for app_type, histogram in other.latency.items():
+            total = self.latency.setdefault(app_type, [0] * len(histogram))
+            for bucket, count in enumerate(histogram):
+                total[bucket] += count
+
+    def take(self):
+        """
+        :return: Metrics with counters since the previous call
+        """
+        metrics = Metrics()
+        metrics.merge(self)
+        self.__init__()
+        return metrics
+
+
+# Metrics of current process
+METRICS = Metrics()
+
+
+class Monitor(object):
+    """
+    Metrics of the whole load in producer. Progress is logged every
+    interval seconds and summary is saved to json file at exit.
+    """
+
+    def __init__(self, interval=PROGRESS_INTERVAL):
+        self.interval = interval
+        self.start = self.logged = time.time()
+        self.metrics = Metrics()
+        self.workers = collections.Counter()
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+
+    def add(self, pid, metrics):
+        """
+        :param pid: pid of worker
+        :param metrics: Metrics of worker
+        """
+        self.metrics.merge(metrics)
+        self.workers[pid] += metrics.seconds["busy"]
+
+    def sample(self, io_queue):
+        """
+        :param io_queue: queue of blocks, size is not available on some
+        platforms
+        """
+        try:
+            self.queue_depth = io_queue.qsize()
+        except NotImplementedError:
+            return
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def tick(self):
+        """Log progress if interval has passed"""
+        if time.time() - self.logged >= self.interval:
+            self.log()
+
+    def log(self):
+        self.logged = time.time()
+        report = self.report()
+        logging.info("Progress: %s lines, %s lines/sec, %s MB/sec, "
+                     "queue depth %s, workers busy %s" %
+                     (report["lines"], report["lines_per_sec"],
+                      report["mb_per_sec"], report["queue_depth"],
+                      ", ".join("%.0f%%" % (busy * 100) for busy in
+                                report["workers_busy"].values())))
+
+    def report(self):
+        """
+        :return: dictionary with metrics of the load
+        """
+        elapsed = max(time.time() - self.start, 1e-9)
+        counts = self.metrics.counts
+        return {
+            "elapsed": round(elapsed, 3),
+            "files": counts["files"],
+            "blocks": counts["blocks"],
+            "lines": counts["lines"],
+            "bytes": counts["bytes"],
+            "lines_per_sec": round(counts["lines"] / elapsed, 1),
+            "mb_per_sec": round(counts["bytes"] / elapsed / 1024 ** 2, 2),
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "seconds": dict((stage, round(seconds, 3)) for stage, seconds
+                            in sorted(self.metrics.seconds.items())),
+            "workers_busy": dict((str(pid), round(busy / elapsed, 3))
+                                 for pid, busy in sorted(self.workers.items())),
+            "latency_ms": {
+                "buckets": list(LATENCY_BUCKETS),
+                "set_multi": self.metrics.latency,
+            },
+        }
+
+    def save(self, path):
+        with open(path, "w") as fd:
+            json.dump(self.report(), fd, indent=2)
+
+
+def timed(items, metrics, stage):
+    """
+    :return: generator of items, time of getting every item is added to
+    stage of metrics
+    """
+    items = iter(items)
+    while True:
+        start = time.time()
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        metrics.seconds[stage] += time.time() - start
+        yield item
+
+
+def process_package(block, memc_clients, options):
+    """
+    :param block: bytes of whole lines from file
+    :param memc_clients: dictionary with memcached Clients for each app device
+    or AsyncLoader
+    :param options: options from OptionsParser
+    :return: number of errors and number of processed lines
+    """
+    start = time.time()
+    columns = parse_block(block)
+    parsed = time.time()
+    METRICS.seconds["parse"] += parsed - start
+
+    if isinstance(memc_clients, AsyncLoader):
+        processed = memc_clients.load(columns)
+        METRICS.seconds["load"] += time.time() - parsed
+        return len(columns) - processed, processed
+
+    processed = 0
+    for code, app_type in enumerate(DEV_TYPES):
+        rows = columns.rows(code)
+        if not rows or app_type not in memc_clients:
+            continue
+        _errors = insert_appsinstalled(app_type, memc_clients[app_type],
+                                       columns, rows, options.dry)
+        processed += len(rows) - _errors
+
+    # Wait for answers and retries of pipelined batches of all devices
+    for memc_client in memc_clients.values():
+        if hasattr(memc_client, "flush"):
+            processed -= len(memc_client.flush())
+
+    METRICS.seconds["load"] += time.time() - parsed
+    return len(columns) - processed, processed
+
+
+def process_file(io_queue, results, ring, device_memc, client_class, options):
     """
     :param io_queue: multiprocessing.Queue to communicate with producer
-    :param file_stats: multiprocessing.Array with value [errors, processed lines]
+    :param results: multiprocessing.Queue to send stats of blocks to producer
+    :param ring: BlockRing with blocks of file
     :param device_memc: memcached addresses for storing values
-    :param memc_clients: dictionary with memcached Clients for each app device
+    :param client_class: class of memcached client, every worker connects
+    to memcached by itself
     :param options: options from OptionsParser
-    :param lock: multiprocessing.Lock for changing file_stats
 
-    Function start process which get packages of string from queue, parse them
-    and store them in memcached in the appropriate device (device_memc)
+    Function start process which get blocks of file from ring, parse their
+    lines and store them in memcached in the appropriate device (device_memc).
+    Number of errors and processed lines of every block are sent back with
+    id of its file and metrics of the worker, so workers share no counters.
     """
 
     # Call basic config for new process, cause it doesn't inherit configuration
@@ -113,92 +1061,212 @@ def process_file(io_queue, file_stats, device_memc, memc_clients, options, lock)
                         format='[%(asctime)s] %(levelname).1s %(message)s',
                         datefmt='%Y.%m.%d %H:%M:%S')
 
+    memc_clients = create_clients(device_memc, client_class, options)
+
     # Handle packages with strings for adding values to memcached
     while True:
-        package = io_queue.get()
-        errors, processed = 0, 0
-        apps = dict((app_type, []) for app_type in device_memc)
-
-        for line in package:
-            appsinstalled = parse_appsinstalled(line)
+        start = time.time()
+        file_id, slot, length = io_queue.get()
+        received = time.time()
+        block = ring.get(slot, length)
+        errors, processed = process_package(block, memc_clients, options)
+        METRICS.seconds["idle"] += received - start
+        METRICS.seconds["busy"] += time.time() - received
+        results.put((file_id, errors, processed, os.getpid(), METRICS.take()))
 
-            if not appsinstalled:
-                errors += 1
-                continue
 
-            if apps.get(appsinstalled.dev_type) is None:
-                errors += 1
-                continue
-
-            apps[appsinstalled.dev_type].append(appsinstalled)
-
-        for app_type, _apps in apps.items():
-            if not _apps:
-                continue
-            _errors = insert_appsinstalled(app_type, memc_clients[app_type], _apps, options.dry)
-            processed += len(_apps) - _errors
-            errors += _errors
-
-        with lock:
-            file_stats[0] += errors
-            file_stats[1] += processed
+def collect(results, file_stats, blocks, monitor):
+    """
+    :param results: multiprocessing.Queue with stats of blocks from workers
+    :param file_stats: dictionary with [errors, processed lines] of every file id
+    :param blocks: number of blocks to wait for
+    :param monitor: Monitor of the load
 
-        io_queue.task_done()
+    Function adds stats of blocks to their files and metrics of workers
+    to monitor
+    """
+    start = time.time()
+    for _ in range(blocks):
+        file_id, errors, processed, pid, metrics = results.get()
+        file_stats[file_id][0] += errors
+        file_stats[file_id][1] += processed
+        monitor.add(pid, metrics)
+    monitor.metrics.seconds["wait"] += time.time() - start
 
 
-def produce(io_queue, options, workers, file_stats):
+def produce(io_queue, results, ring, options, workers):
     """
     :param io_queue: multiprocessing.Queue to communicate with producer
+    :param results: multiprocessing.Queue with stats of blocks from workers
+    :param ring: BlockRing to send blocks of file to workers
     :param options: options from OptionsParser
     :param workers: number of isolated consumers which load values to memcached
-    :param file_stats: multiprocessing.Array with value [errors, processed lines]
 
     The function is reading content of the files which satisfy pattern options.pattern
-    and send packages of strings to io_queue.
-    When work is done func produce terminates consumers processes.
+    and send blocks of lines to workers through ring and io_queue. File is
+    finished when stats of all its blocks are received. Every
+    options.checkpoint blocks it waits for stats of sent blocks and saves
+    state of file. When work is done func produce terminates consumers processes.
+    :return: Monitor of the load
     """
+    file_stats = collections.defaultdict(lambda: [0, 0])
+    monitor = Monitor()
+    metrics = monitor.metrics
 
     # Iterate through appropriate files defined by pattern in options.patterns
-    for fn in sorted(glob.iglob(options.pattern)):
+    for file_id, fn in enumerate(sorted(glob.iglob(options.pattern))):
 
         logging.info('Processing %s' % fn)
-        fd = gzip.open(fn, 'rt')
+        fd, state = open_file(fn, options)
+        file_stats[file_id] = [state["errors"], state["processed"]]
 
-        package = list(islice(fd, PACKAGE_SIZE))
-        while package:
-            io_queue.put(package)
-            package = list(islice(fd, PACKAGE_SIZE))
+        if not state["done"]:
+            pending = 0
+            blocks = timed(read_blocks(fd, ring.block_size), metrics, "read")
+            for number, block in enumerate(blocks, 1):
+                start = time.time()
+                io_queue.put((file_id,) + ring.put(block))
+                metrics.seconds["ipc"] += time.time() - start
+                pending += 1
 
-        io_queue.join()
+                lines = count_lines(block)
+                state["offset"] += len(block)
+                state["lines"] += lines
+                metrics.counts.update(blocks=1, lines=lines, bytes=len(block))
+                monitor.sample(io_queue)
+                monitor.tick()
 
-        if not file_stats[1]:
-            file_stats[0], file_stats[1] = 0, 0
-            fd.close()
-            dot_rename(fn)
-            continue
+                if number % options.checkpoint == 0:
+                    collect(results, file_stats, pending, monitor)
+                    pending = 0
+                    state["errors"], state["processed"] = file_stats[file_id]
+                    write_state(fn, state)
 
-        err_rate = file_stats[0] / file_stats[1]
-        file_stats[0], file_stats[1] = 0, 0
+            collect(results, file_stats, pending, monitor)
+            state["errors"], state["processed"] = file_stats[file_id]
+            state["done"] = True
+            write_state(fn, state)
 
-        if err_rate < NORMAL_ERR_RATE:
-            logging.info("Acceptable error rate (%s). Successfull load" % err_rate)
-        else:
-            logging.error("High error rate (%s > %s). Failed load" %
-                          (err_rate, NORMAL_ERR_RATE))
+        del file_stats[file_id]
         fd.close()
-        dot_rename(fn)
+        finish_file(fn, state["errors"], state["processed"])
+        metrics.counts["files"] += 1
 
     # Terminate all workers which have done the work
     for worker in workers:
         worker.terminate()
 
+    monitor.log()
+    return monitor
+
+
+def check_error_rate(errors, processed):
+    """
+    :param errors: number of errors in file
+    :param processed: number of lines of file loaded to memcached
+
+    Function logs if load of file is successful
+    """
+    if not processed:
+        return
+
+    err_rate = errors / processed
+    if err_rate < NORMAL_ERR_RATE:
+        logging.info("Acceptable error rate (%s). Successfull load" % err_rate)
+    else:
+        logging.error("High error rate (%s > %s). Failed load" %
+                      (err_rate, NORMAL_ERR_RATE))
+
+
+def load_file(args):
+    """
+    :param args: tuple with name of file, memcached addresses for each app
+    device, class of memcached client and options from OptionsParser
+    :return: name of file, number of errors, number of processed lines, pid
+    and Metrics of the process
+
+    Function runs in pool process, it decompresses, parses and loads the
+    whole file with its own memcached clients and saves state of the file
+    every options.checkpoint blocks
+    """
+    fn, device_memc, client_class, options = args
+    logging.basicConfig(filename=options.log,
+                        level=logging.INFO if not options.dry else logging.DEBUG,
+                        format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    logging.info('Processing %s' % fn)
+
+    start = time.time()
+    fd, state = open_file(fn, options)
+
+    with fd:
+        if state["done"]:
+            return fn, state["errors"], state["processed"], os.getpid(), Metrics()
+
+        # Clients live only while the file is loaded, the next file of
+        # the process creates its own
+        memc_clients = create_clients(device_memc, client_class, options)
+        try:
+            blocks = timed(read_blocks(fd), METRICS, "read")
+            for number, block in enumerate(blocks, 1):
+                errors, processed = process_package(block, memc_clients, options)
+                state["errors"] += errors
+                state["processed"] += processed
+
+                lines = count_lines(block)
+                state["offset"] += len(block)
+                state["lines"] += lines
+                METRICS.counts.update(blocks=1, lines=lines, bytes=len(block))
+
+                if number % options.checkpoint == 0:
+                    write_state(fn, state)
+        finally:
+            close_clients(memc_clients)
+
+    state["done"] = True
+    write_state(fn, state)
+    METRICS.seconds["busy"] += time.time() - start
+    return fn, state["errors"], state["processed"], os.getpid(), METRICS.take()
+
+
+def produce_files(options, device_memc, client_class=MemcClient):
+    """
+    :param options: options from OptionsParser
+    :param device_memc: memcached addresses for each app device
+    :param client_class: class of memcached client
+
+    The function gives whole files which satisfy pattern options.pattern to
+    pool of options.workers processes, so files are decompressed in parallel.
+    Results come in order of files, every file is checked and renamed when
+    it and all files before it are loaded.
+    :return: Monitor of the load
+    """
+    files = sorted(glob.iglob(options.pattern))
+    monitor = Monitor()
+    pool = Pool(options.workers)
+    try:
+        for fn, errors, processed, pid, metrics in pool.imap(
+                load_file, [(fn, device_memc, client_class, options)
+                            for fn in files]):
+            logging.info('Processed %s' % fn)
+            finish_file(fn, errors, processed)
+            monitor.add(pid, metrics)
+            monitor.metrics.counts["files"] += 1
+            monitor.tick()
+    finally:
+        pool.close()
+        pool.join()
+
+    monitor.log()
+    return monitor
+
 
 def main(options):
     """
     :param options: options from OptionsParser
 
     Function start several processes (number of which defined in options.workers)
-    and creates multiprocessing array and lock for further communication between
+    and creates queues and shared memory for further communication between
     all processes of the program.
     """
 
@@ -210,28 +1278,33 @@ def main(options):
         "dvid": options.dvid,
     }
 
-    # Create primitives for intercommunication
-    lock = Lock()
-    file_stats = Array(typecode_or_type='i', size_or_initializer=2)
+    if options.per_file:
+        monitor = produce_files(options, device_memc)
+        if options.summary:
+            monitor.save(options.summary)
+        return
 
-    # Memcached clients
-    memc_clients = dict((key, memcache.Client([address]))
-                        for key, address in device_memc.items())
+    # Every worker can parse one block while another one waits for it
+    ring = BlockRing(2 * options.workers)
 
-    # Create Queue for implementing producer -> consumer communication
-    io_queue = JoinableQueue()
+    # Create Queues for implementing producer -> consumer communication
+    # and for stats of blocks from consumers
+    io_queue = Queue()
+    results = Queue()
 
     # Start consumer processes
     workers = []
     for i in range(options.workers):
-        p = Process(target=process_file, args=(io_queue, file_stats,
-                                               device_memc, memc_clients,
-                                               options, lock))
+        p = Process(target=process_file, args=(io_queue, results, ring,
+                                               device_memc, MemcClient,
+                                               options))
         p.start()
         workers.append(p)
 
     # Start producer process
-    produce(io_queue, options, workers, file_stats)
+    monitor = produce(io_queue, results, ring, options, workers)
+    if options.summary:
+        monitor.save(options.summary)
 
 
 def prototest():
@@ -262,6 +1335,15 @@ if __name__ == '__main__':
     op.add_option("--adid", action="store", default="127.0.0.1:33015")
     op.add_option("--dvid", action="store", default="127.0.0.1:33016")
     op.add_option("-w", "--workers", action="store", type="int", default=1)
+    op.add_option("--per_file", action="store_true", default=False)
+    op.add_option("--engine", action="store", type="choice", choices=ENGINES,
+                  default="sync")
+    op.add_option("--retries", action="store", type="int", default=RETRIES)
+    op.add_option("--dead_letter", action="store", default=None)
+    op.add_option("--checkpoint", action="store", type="int",
+                  default=CHECKPOINT_BLOCKS)
+    op.add_option("--resume", action="store_true", default=False)
+    op.add_option("--summary", action="store", default=None)
     (opts, args) = op.parse_args()
 
     logging.basicConfig(filename=opts.log, level=logging.INFO if not opts.dry else logging.DEBUG,
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import random
+
+from multiprocessing import Process, RawValue
+from optparse import OptionParser
+
+# ******************** CONSTANTS ******************* #
+
+DEV_TYPES = ("idfa", "gaid", "adid", "dvid")
+
+
+# ******************** SIMULATOR ******************* #
+
+class MemcSimulator(object):
+    """
+    Local stand-in of memcached for every device type. It understands set
+    command of text protocol, answers STORED or NOT_STORED for part of
+    keys and only counts values without storing them. All ports are served
+    by one event loop in separate process, so the stand-in does not take
+    time of the loader process.
+    """
+
+    def __init__(self, host="127.0.0.1", port=33013, fail_rate=0.0):
+        """
+        :param host: host of all ports
+        :param port: port of the first device type, other device types
+        use next ports
+        :param fail_rate: share of keys which are not stored
+        """
+        self.host = host
+        self.ports = dict((dev_type, port + number)
+                          for number, dev_type in enumerate(DEV_TYPES))
+        self.fail_rate = fail_rate
+        self.stored = RawValue('q', 0)
+        self.failed = RawValue('q', 0)
+        self.process = None
+
+    @property
+    def addresses(self):
+        """
+        :return: dictionary with addresses of memcached of every device type
+        """
+        return dict((dev_type, "%s:%s" % (self.host, port))
+                    for dev_type, port in self.ports.items())
+
+    def start(self):
+        started = RawValue('b', 0)
+        self.process = Process(target=self.run, args=(started,))
+        self.process.daemon = True
+        self.process.start()
+        while not started.value and self.process.is_alive():
+            self.process.join(0.01)
+        if not started.value:
+            raise RuntimeError("Cannot start memcached simulator")
+        return self
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+    def run(self, started):
+        loop = asyncio.new_event_loop()
+        for port in self.ports.values():
+            loop.run_until_complete(asyncio.start_server(
+                self.serve, self.host, port))
+        started.value = 1
+        loop.run_forever()
+
+    def answer(self, buffer):
+        """
+        :param buffer: received bytes
+        :return: answers to whole commands of buffer and length of them
+        """
+        answers, position = [], 0
+        while True:
+            end = buffer.find(b"\r\n", position)
+            if end < 0:
+                break
+            parts = buffer[position:end].split()
+            if not parts or parts[0] != b"set" or len(parts) < 5:
+                answers.append(b"ERROR\r\n")
+                position = end + 2
+                continue
+
+            command_end = end + 2 + int(parts[4]) + 2
+            if command_end > len(buffer):
+                break
+            position = command_end
+            if self.fail_rate and random.random() < self.fail_rate:
+                self.failed.value += 1
+                answers.append(b"NOT_STORED\r\n")
+            else:
+                self.stored.value += 1
+                answers.append(b"STORED\r\n")
+        return b"".join(answers), position
+
+    async def serve(self, reader, writer):
+        """Answers to all commands of received data are sent together"""
+        buffer = b""
+        try:
+            while True:
+                data = await reader.read(256 * 1024)
+                if not data:
+                    break
+                buffer += data
+                answers, position = self.answer(buffer)
+                buffer = buffer[position:]
+                writer.write(answers)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+# ******************** MAIN ******************* #
+
+if __name__ == '__main__':
+    op = OptionParser()
+    op.add_option("-H", "--host", action="store", default="127.0.0.1")
+    op.add_option("-p", "--port", action="store", type="int", default=33013,
+                  help="port of idfa, gaid, adid and dvid use next ports")
+    op.add_option("--fail_rate", action="store", type="float", default=0.0)
+    (opts, args) = op.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+
+    simulator = MemcSimulator(opts.host, opts.port, opts.fail_rate)
+    for dev_type, address in sorted(simulator.addresses.items()):
+        logging.info("--%s %s" % (dev_type, address))
+    try:
+        simulator.run(RawValue('b', 0))
+    except KeyboardInterrupt:
+        pass
@@ -1,15 +1,25 @@
+import asyncio
 import collections
 import datetime
 import gzip
 import hashlib
+import json
 import os
+import shutil
+import socket
+import tempfile
+import threading
 import unittest
 
-from multiprocessing import Array, JoinableQueue, Lock, Process, Manager
+from multiprocessing import Manager, Process, Queue
+from optparse import Values
 
-import appsinstalled_pb2
+from appsinstalled_gen import generate_file
 
-from memc_multi_load import produce, process_file, parse_appsinstalled
+from memc_multi_load import (BAD_APPS, BAD_FORMAT, BAD_GEO, DEV_TYPE_CODES,
+                             UNKNOWN_DEVICE, AsyncLoader, BlockRing, MemcClient,
+                             RetryClient, pack_rows, parse_block, produce,
+                             produce_files, process_file)
 
 
 # *************** HELPER CLASSES **************** #
@@ -37,6 +47,56 @@ class MockMem:
             self.storage.update(package)
             return []
 
+    class FlakyClient:
+        """
+        Client which fails all keys of the first failures calls
+        """
+
+        def __init__(self, failures):
+            self.storage = {}
+            self.failures = failures
+
+        def set_multi(self, package):
+            if self.failures:
+                self.failures -= 1
+                return list(package)
+            self.storage.update(package)
+            return []
+
+
+class FakeSocket:
+    """
+    Socket which answers with given lines and then times out
+    """
+
+    def __init__(self, answers):
+        self.sent = []
+        self.answers = collections.deque(answers)
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+    def readline(self):
+        if not self.answers:
+            raise socket.timeout("timed out")
+        return self.answers.popleft()
+
+    def close(self):
+        pass
+
+
+class FakeMemcClient(MemcClient):
+    """
+    MemcClient which connects to FakeSocket
+    """
+
+    def __init__(self, answers, depth):
+        super().__init__(['127.0.0.1:0'], depth=depth)
+        self.fake = FakeSocket(answers)
+
+    def connect(self):
+        self.sock = self.answers = self.fake
+
 
 # **************** TEST CLASSES ***************** #
 
@@ -57,11 +117,8 @@ class TestLoad(unittest.TestCase):
 
     @staticmethod
     def parse_value(line):
-        appsinstalled = parse_appsinstalled(line)
-        ua = appsinstalled_pb2.UserApps()
-        ua.lat = appsinstalled.lat
-        ua.lon = appsinstalled.lon
-        ua.apps.extend(appsinstalled.apps)
+        columns = parse_block(line.encode('utf-8'))
+        (_, ua), = pack_rows(line.split('\t', 1)[0], columns, [0])
         return ua.SerializeToString()
 
     # ------------------ TESTS ------------------- #
@@ -80,44 +137,274 @@ class TestLoad(unittest.TestCase):
         options.pattern = self.filename
         options.dry = False
         options.log = None
+        options.retries = 0
+        options.dead_letter = None
+        options.checkpoint = 1
+        options.resume = False
 
         # Create primitives for intercommunication
-        lock = Lock()
-        file_stats = Array(typecode_or_type='i', size_or_initializer=2)
-
-        # Memcached clients
-        memc_clients = dict((key, MockMem.Client([address]))
-                            for key, address in device_memc.items())
+        ring = BlockRing(2)
 
-        # Create Queue for implementing producer -> consumer communication
-        io_queue = JoinableQueue()
+        # Create Queues for implementing producer -> consumer communication
+        io_queue = Queue()
+        results = Queue()
 
         # Start consumer processes
         workers = []
-        p = Process(target=process_file, args=(io_queue, file_stats,
-                                               device_memc, memc_clients,
-                                               options, lock))
+        p = Process(target=process_file, args=(io_queue, results, ring,
+                                               device_memc, MockMem.Client,
+                                               options))
         p.start()
         workers.append(p)
 
         # Start producer process
-        produce(io_queue, options, workers, file_stats)
+        produce(io_queue, results, ring, options, workers)
 
-        self.assertIsNotNone(memc_clients['gaid'].storage.get('gaid:7rfw452y52g2gq4g'))
-        self.assertIsNotNone(memc_clients['idfa'].storage.get('idfa:1rfw452y52g2gq4g'))
-        self.assertEqual(memc_clients['gaid'].storage.get('gaid:7rfw452y52g2gq4g'),
+        self.assertIsNotNone(device_memc['gaid'].get('gaid:7rfw452y52g2gq4g'))
+        self.assertIsNotNone(device_memc['idfa'].get('idfa:1rfw452y52g2gq4g'))
+        self.assertEqual(device_memc['gaid'].get('gaid:7rfw452y52g2gq4g'),
                          self.parse_value(self.lines[1]))
-        self.assertEqual(memc_clients['idfa'].storage.get('idfa:1rfw452y52g2gq4g'),
+        self.assertEqual(device_memc['idfa'].get('idfa:1rfw452y52g2gq4g'),
                          self.parse_value(self.lines[0]))
 
+    def test_functional_per_file(self):
+        """ Load files in parallel to mock database """
+        manager = Manager()
+        device_memc = {
+            "idfa": manager.dict(),
+            "gaid": manager.dict(),
+            "adid": manager.dict(),
+            "dvid": manager.dict(),
+        }
+
+        # Second file with other device ids
+        second_filename = 'z' + self.filename
+        with gzip.open(second_filename, 'wt') as gzip_file:
+            gzip_file.write(self.lines[0].replace('1rfw', '2rfw'))
+
+        options = Values({'pattern': '*' + self.filename, 'dry': False,
+                          'log': None, 'workers': 2, 'retries': 0,
+                          'dead_letter': None, 'checkpoint': 1,
+                          'resume': False})
+        produce_files(options, device_memc, MockMem.Client)
+        os.remove('.' + second_filename)
+
+        self.assertEqual(device_memc['gaid'].get('gaid:7rfw452y52g2gq4g'),
+                         self.parse_value(self.lines[1]))
+        self.assertEqual(device_memc['idfa'].get('idfa:1rfw452y52g2gq4g'),
+                         self.parse_value(self.lines[0]))
+        self.assertEqual(device_memc['idfa'].get('idfa:2rfw452y52g2gq4g'),
+                         self.parse_value(self.lines[0]))
+
+    def test_resume(self):
+        """ Resume load of file from checkpoint """
+        manager = Manager()
+        device_memc = {
+            "idfa": manager.dict(),
+            "gaid": manager.dict(),
+            "adid": manager.dict(),
+            "dvid": manager.dict(),
+        }
+
+        # State of file after its first line
+        with open(self.filename + '.state', 'w') as state_file:
+            json.dump({'offset': len(self.lines[0]), 'lines': 1, 'errors': 0,
+                       'processed': 1, 'done': False}, state_file)
+
+        options = Values({'pattern': self.filename, 'dry': False,
+                          'log': None, 'workers': 1, 'retries': 0,
+                          'dead_letter': None, 'checkpoint': 1,
+                          'resume': True})
+        produce_files(options, device_memc, MockMem.Client)
+
+        self.assertIsNone(device_memc['idfa'].get('idfa:1rfw452y52g2gq4g'))
+        self.assertEqual(device_memc['gaid'].get('gaid:7rfw452y52g2gq4g'),
+                         self.parse_value(self.lines[1]))
+        self.assertFalse(os.path.exists(self.filename + '.state'))
+
     def tearDown(self):
         os.remove('.' + self.filename)
 
 
+class TestRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.line = "idfa\t1rfw452y52g2gq4g\t55.55\t42.42\t1423,43,567,3,7,23\n"
+
+    def test_retry_dead_letter(self):
+        """ Retry failed keys and write the rest to dead letter file """
+        value = TestLoad.parse_value(self.line)
+        directory = tempfile.mkdtemp()
+        try:
+            flaky = MockMem.FlakyClient(failures=1)
+            client = RetryClient('idfa', flaky, retries=2, dead_letter=directory)
+            self.assertEqual(client.set_multi({'idfa:1rfw452y52g2gq4g': value}), [])
+            self.assertEqual(client.flush(), [])
+            self.assertEqual(flaky.storage['idfa:1rfw452y52g2gq4g'], value)
+
+            flaky = MockMem.FlakyClient(failures=3)
+            client = RetryClient('idfa', flaky, retries=2, dead_letter=directory)
+            client.set_multi({'idfa:1rfw452y52g2gq4g': value})
+            self.assertEqual(client.flush(), ['idfa:1rfw452y52g2gq4g'])
+
+            dead_letters = os.listdir(directory)
+            self.assertEqual(len(dead_letters), 1)
+            with gzip.open(os.path.join(directory, dead_letters[0]), 'rt') as fd:
+                lines = fd.readlines()
+            self.assertEqual(len(lines), 1)
+            self.assertEqual(TestLoad.parse_value(lines[0]), value)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_invalid_keys(self):
+        """ Write invalid keys to dead letter file without retries """
+        value = TestLoad.parse_value(self.line)
+        directory = tempfile.mkdtemp()
+        try:
+            memc = FakeMemcClient([b"STORED\r\n"], depth=1)
+            client = RetryClient('idfa', memc, retries=2, dead_letter=directory)
+            client.set_multi({'idfa:1rfw452y52g2gq4g': value, 'idfa:bad id': value})
+            self.assertEqual(client.flush(), ['idfa:bad id'])
+            self.assertEqual(client.failures, 0)
+            self.assertEqual(len(memc.fake.sent), 1)
+
+            dead_letters = os.listdir(directory)
+            self.assertEqual(len(dead_letters), 1)
+            with gzip.open(os.path.join(directory, dead_letters[0]), 'rt') as fd:
+                lines = fd.readlines()
+            self.assertEqual(len(lines), 1)
+            self.assertTrue(lines[0].startswith('idfa\tbad id\t'))
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestMemcClient(unittest.TestCase):
+
+    def test_timeout_in_batch(self):
+        """ Keys of batch without answers fail after timeout """
+        client = FakeMemcClient([b"STORED\r\n"], depth=1)
+        self.assertEqual(client.set_multi({'idfa:1': b'1', 'idfa:2': b'2'}), [])
+        self.assertEqual(sorted(client.set_multi({'idfa:3': b'3'})),
+                         ['idfa:1', 'idfa:2', 'idfa:3'])
+        self.assertEqual(len(client.in_flight), 0)
+        self.assertEqual(client.flush(), [])
+
+    def test_answers_in_order(self):
+        """ Only keys with NOT_STORED answer fail """
+        client = FakeMemcClient([b"STORED\r\n", b"NOT_STORED\r\n",
+                                 b"STORED\r\n"], depth=1)
+        self.assertEqual(client.set_multi({'idfa:1': b'1', 'idfa:2': b'2'}), [])
+        self.assertEqual(client.set_multi({'idfa:3': b'3'}), ['idfa:2'])
+        self.assertEqual(client.flush(), [])
+        self.assertEqual(len(client.fake.sent), 2)
+
+
+class TestParse(unittest.TestCase):
+
+    def test_parse_block(self):
+        """ Parse block to columns and flag wrong lines """
+        block = b"idfa\t1rfw452y52g2gq4g\t55.55\t42.42\t1423,43,567\n" \
+                b"gaid\t7rfw452y52g2gq4g\n" \
+                b"xxxx\t7rfw452y52g2gq4g\t55.55\t42.42\t7423,424\n" \
+                b"adid\t7rfw452y52g2gq4g\tlat\t42.42\t7423,424\n" \
+                b"dvid\t7rfw452y52g2gq4g\t55.55\t42.42\t7423,a,424\n"
+        columns = parse_block(block)
+
+        self.assertEqual(list(columns.flags),
+                         [0, BAD_FORMAT, UNKNOWN_DEVICE, BAD_GEO, BAD_APPS])
+        self.assertEqual(columns.dev_ids[0], b"1rfw452y52g2gq4g")
+        self.assertEqual((columns.lats[0], columns.lons[0]), (55.55, 42.42))
+        self.assertEqual(list(columns.apps[columns.offsets[0]:columns.offsets[1]]),
+                         [1423, 43, 567])
+        self.assertEqual(list(columns.apps[columns.offsets[4]:columns.offsets[5]]),
+                         [7423, 424])
+        self.assertEqual(columns.rows(DEV_TYPE_CODES[b"idfa"]), [0])
+        self.assertEqual(columns.rows(DEV_TYPE_CODES[b"adid"]), [])
+        self.assertEqual(columns.rows(DEV_TYPE_CODES[b"dvid"]), [4])
+
+    def test_generated_file(self):
+        """ Parse generated file with invalid lines """
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'generated.tsv.gz')
+        options = Values({'skew': 'idfa:1,dvid:1', 'apps': 5,
+                          'invalid_rate': 0.1, 'compress': 1})
+        try:
+            generate_file(path, 1000, options, seed=1)
+            with gzip.open(path, 'rb') as fd:
+                columns = parse_block(fd.read())
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(len(columns), 1000)
+        self.assertTrue(0 < sum(1 for flags in columns.flags if flags) < 200)
+        self.assertEqual(columns.rows(DEV_TYPE_CODES[b"gaid"]), [])
+        self.assertGreater(len(columns.rows(DEV_TYPE_CODES[b"dvid"])), 300)
+
+    def test_parse_wrong_apps(self):
+        """ Keep apps which are numbers and flag the line """
+        columns = parse_block(b"dvid\t7rfw452y52g2gq4g\t55.55\t42.42\t7423, a,424")
+        self.assertEqual(list(columns.flags), [BAD_APPS])
+        self.assertEqual(list(columns.apps[columns.offsets[0]:columns.offsets[1]]),
+                         [7423, 424])
+
+
+class TestAsync(unittest.TestCase):
+
+    @staticmethod
+    async def serve(reader, writer, storage):
+        """ Store values of set commands like memcached """
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            _, key, _, _, length = line.split()
+            storage[key.decode()] = (await reader.readexactly(int(length) + 2))[:-2]
+            writer.write(b"STORED\r\n")
+        writer.close()
+
+    def test_async_loader(self):
+        """ Load block through asyncio clients """
+        storage = {}
+
+        # Mock memcached runs in its own thread and event loop
+        server_loop = asyncio.new_event_loop()
+        server = server_loop.run_until_complete(asyncio.start_server(
+            lambda reader, writer: self.serve(reader, writer, storage),
+            '127.0.0.1', 0))
+        port = server.sockets[0].getsockname()[1]
+        thread = threading.Thread(target=server_loop.run_forever)
+        thread.start()
+
+        options = Values({'dry': False, 'retries': 0, 'dead_letter': None})
+        loader_ = AsyncLoader({'idfa': '127.0.0.1:%s' % port,
+                               'gaid': '127.0.0.1:%s' % port}, options)
+        try:
+            columns = parse_block(
+                b"idfa\t1rfw452y52g2gq4g\t55.55\t42.42\t1423,43,567\n"
+                b"gaid\t7rfw452y52g2gq4g\t55.55\t42.42\t7423,424\n"
+                b"dvid\t7rfw452y52g2gq4g\t55.55\t42.42\t7423,424\n")
+            self.assertEqual(loader_.load(columns), 2)
+        finally:
+            loader_.close()
+            asyncio.run_coroutine_threadsafe(asyncio.sleep(0.1),
+                                             server_loop).result()
+            server_loop.call_soon_threadsafe(server_loop.stop)
+            thread.join()
+            server.close()
+
+        self.assertEqual(storage['idfa:1rfw452y52g2gq4g'], TestLoad.parse_value(
+            "idfa\t1rfw452y52g2gq4g\t55.55\t42.42\t1423,43,567"))
+        self.assertIn('gaid:7rfw452y52g2gq4g', storage)
+
+
 loader = unittest.TestLoader()
 suite = unittest.TestSuite()
 a = loader.loadTestsFromTestCase(TestLoad)
 suite.addTest(a)
+suite.addTest(loader.loadTestsFromTestCase(TestRetry))
+suite.addTest(loader.loadTestsFromTestCase(TestMemcClient))
+suite.addTest(loader.loadTestsFromTestCase(TestParse))
+suite.addTest(loader.loadTestsFromTestCase(TestAsync))
 
 
 class NewResult(unittest.TextTestResult):